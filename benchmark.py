@@ -0,0 +1,321 @@
+import os
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import threading
+import contextlib
+import subprocess
+import importlib.util
+import hydrus_api
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+# Benchmark for hydrus-transcode, it doesn't need (and doesn't touch) a real hydrus
+# A stand-in hydrus client api is started locally, serving a generated library of given size
+# Only handful of files in the library exist on disk as real images and videos, the rest only exists in metadata
+# and is small enough to be skipped by the script, so the api side and file lookups scale while encoding stays constant
+#
+# Library of size N looks like this:
+# - N original files, every second one of them has a transcode
+# - every tenth transcode points to an original that was deleted from hydrus, those get removed by the cleanup pass
+# - first MEDIA_FILES originals without transcode are real files in generated client_files tree
+
+SCRIPT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'hydrus-transcode.py')
+# Library sizes benchmarked by default
+LIBRARY_SIZES = [1000, 100000, 1000000]
+# How many originals get a real file on disk
+MEDIA_FILES = 12
+# Every n-th transcode points to a deleted original
+DELETED_EVERY = 10
+# Synthetic media, cycled through when making real files
+# extension, mime, width, height, duration in seconds (None for images)
+MEDIA_SAMPLES = [
+    ('.jpg', 'image/jpeg', 2400, 1600, None),
+    ('.png', 'image/png', 1600, 1200, None),
+    ('.mp4', 'video/mp4', 1920, 1080, 2),
+]
+VIDEO_FRAME_RATE = 30
+
+# Kinds of files in the library, kind is stored in the hash itself so server doesn't have to keep millions of hashes around
+KIND_ORIGINAL = 0
+KIND_TRANSCODE = 1
+KIND_DELETED = 2
+
+# Hash layout: 2 characters spreading files over fXX folders, 1 character of kind, 61 characters of index
+def make_hash(kind:int, index:int) -> str:
+    return f'{(index * 151 + kind * 89) % 256:02x}{kind:x}{index:061x}'
+
+# Returns kind and index of hash made by make_hash, None for any other hash
+def parse_hash(hash:str):
+    try:
+        kind, index = int(hash[2], 16), int(hash[3:], 16)
+    except (ValueError, IndexError):
+        return None
+    if len(hash) != 64 or make_hash(kind, index) != hash:
+        return None
+    return kind, index
+
+class MediaFile:
+    def __init__(self,path:str,extension:str,mime:str,width:int,height:int,duration:float):
+        self.path:str = path
+        self.extension:str = extension
+        self.mime:str = mime
+        self.size:int = os.stat(path).st_size
+        self.width:int = width
+        self.height:int = height
+        self.duration:float = duration
+        self.frames:int = duration * VIDEO_FRAME_RATE if duration else None
+
+# Makes one file of every sample with ffmpeg, those get linked into every generated library
+def generate_media_samples(folder:str) -> list[MediaFile]:
+    samples = []
+    for extension, mime, width, height, duration in MEDIA_SAMPLES:
+        path = f'{folder}/sample{extension}'
+        source = ['-f', 'lavfi', '-i', f'testsrc2=size={width}x{height}:rate={VIDEO_FRAME_RATE}']
+        if duration:
+            arguments = [*source, '-t', str(duration), '-c:v', 'mpeg4', '-q:v', '2', '-pix_fmt', 'yuv420p']
+        elif extension == '.jpg':
+            arguments = [*source, '-frames:v', '1', '-q:v', '2']
+        else:
+            arguments = [*source, '-frames:v', '1']
+        process = subprocess.run(['ffmpeg', '-y', *arguments, path], capture_output=True, text=True)
+        if process.returncode != 0:
+            raise RuntimeError(f'Generating {path} failed:\n{process.stderr}')
+        samples.append(MediaFile(path, extension, mime, width, height, duration))
+    return samples
+
+class FakeLibrary:
+    def __init__(self,size:int,media:list[MediaFile],media_files:int,namespace:str,tag_service:str,file_service:str):
+        self.size:int = size
+        self.namespace:str = namespace
+        self.tag_service:str = tag_service
+        self.file_service:str = file_service
+        # original index => real file, real files are originals without transcode (odd indexes)
+        self.media:dict[int,MediaFile] = {}
+        if media:
+            for number, index in enumerate(range(1, min(size, media_files * 2), 2)):
+                self.media[index] = media[number % len(media)]
+        # Indexes of transcodes deleted through the api
+        self.deleted:set[int] = set()
+        self.lock = threading.Lock()
+        self.requests = 0
+
+    def has_transcode(self, index:int) -> bool:
+        return 0 <= index < self.size and index % 2 == 0 and index not in self.deleted
+
+    def get_original_of_transcode(self, index:int) -> str:
+        if (index // 2) % DELETED_EVERY == 0:
+            return make_hash(KIND_DELETED, index)
+        return make_hash(KIND_ORIGINAL, index)
+
+    def get_expected_orphans(self) -> int:
+        return len(range(0, self.size, 2 * DELETED_EVERY))
+
+    # Writes client_files tree, all 256 folders like in real hydrus and links real files into it
+    def write_client_files(self, folder:str):
+        for prefix in range(256):
+            os.makedirs(f'{folder}/f{prefix:02x}', exist_ok=True)
+        for index, media in self.media.items():
+            hash = make_hash(KIND_ORIGINAL, index)
+            path = f'{folder}/f{hash[0:2]}/{hash}{media.extension}'
+            try:
+                os.link(media.path, path)
+            except OSError:
+                shutil.copyfile(media.path, path)
+
+    def search(self, tags:list, file_service_name:str) -> list[str]:
+        if tags == [f'{self.namespace}:*']:
+            with self.lock:
+                return [make_hash(KIND_TRANSCODE, index) for index in range(0, self.size, 2) if index not in self.deleted]
+        if len(tags) == 1 and isinstance(tags[0], str) and tags[0].startswith(f'{self.namespace}:'):
+            parsed = parse_hash(tags[0].removeprefix(f'{self.namespace}:'))
+            if parsed is None:
+                return []
+            kind, index = parsed
+            with self.lock:
+                if kind != KIND_TRANSCODE and self.has_transcode(index) and self.get_original_of_transcode(index) == make_hash(kind, index):
+                    return [make_hash(KIND_TRANSCODE, index)]
+            return []
+        # Any other search returns every original
+        return [make_hash(KIND_ORIGINAL, index) for index in range(self.size)]
+
+    def get_metadata(self, hash:str) -> dict:
+        parsed = parse_hash(hash)
+        if parsed is None:
+            return {'hash': hash}
+        kind, index = parsed
+        if kind == KIND_ORIGINAL and 0 <= index < self.size:
+            media = self.media.get(index)
+            entry = {'hash': hash, 'file_id': index, 'is_local': True, 'is_trashed': False, 'is_deleted': False, 'tags': {self.tag_service: {'display_tags': {'0': []}}}}
+            if media:
+                entry.update({'ext': media.extension, 'mime': media.mime, 'size': media.size, 'width': media.width, 'height': media.height,
+                              'duration': media.duration * 1000 if media.duration else None, 'num_frames': media.frames})
+            else:
+                # Below MIN_IMAGE_SIZE and within resize bounds, so the script skips it without reading the file
+                entry.update({'ext': '.jpg', 'mime': 'image/jpeg', 'size': 60 * 1024, 'width': 800, 'height': 600, 'duration': None, 'num_frames': None})
+            return entry
+        if kind == KIND_TRANSCODE and self.has_transcode(index):
+            return {'hash': hash, 'file_id': self.size + index, 'is_local': True, 'is_trashed': False, 'is_deleted': False,
+                    'ext': '.webp', 'mime': 'image/webp', 'size': 30 * 1024, 'width': 800, 'height': 600,
+                    'tags': {self.tag_service: {'display_tags': {'0': [f'{self.namespace}:{self.get_original_of_transcode(index)}']}}}}
+        return {'hash': hash}
+
+    def delete(self, hashes:list[str]):
+        with self.lock:
+            for hash in hashes:
+                parsed = parse_hash(hash)
+                if parsed is not None and parsed[0] == KIND_TRANSCODE:
+                    self.deleted.add(parsed[1])
+
+# Answers just enough of hydrus client api for the script
+class FakeHydrusHandler(BaseHTTPRequestHandler):
+    library:FakeLibrary = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, body):
+        data = json.dumps(body).encode() if body is not None else b''
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        library = self.library
+        with library.lock:
+            library.requests += 1
+        url = urlparse(self.path)
+        parameters = {key: values[0] for key, values in parse_qs(url.query).items()}
+        if url.path == '/api_version':
+            self.send_json({'version': 31})
+        elif url.path == '/get_services':
+            self.send_json({
+                'local_tags': [{'name': 'my tags', 'service_key': library.tag_service}],
+                'local_files': [{'name': 'my files', 'service_key': '6c6f63616c2066696c6573'},
+                                {'name': library.file_service, 'service_key': '7765622d7472616e73636f646573'}],
+            })
+        elif url.path == '/get_files/search_files':
+            hashes = library.search(json.loads(parameters.get('tags', '[]')), parameters.get('file_service_name'))
+            if json.loads(parameters.get('return_hashes', 'false')):
+                self.send_json({'hashes': hashes})
+            else:
+                self.send_json({'file_ids': [library.get_metadata(hash).get('file_id') for hash in hashes]})
+        elif url.path == '/get_files/file_metadata':
+            self.send_json({'metadata': [library.get_metadata(hash) for hash in json.loads(parameters.get('hashes', '[]'))]})
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+        library = self.library
+        with library.lock:
+            library.requests += 1
+        url = urlparse(self.path)
+        body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        if url.path == '/add_files/delete_files':
+            library.delete(body.get('hashes', []))
+            self.send_json(None)
+        elif url.path == '/add_tags/add_tags':
+            self.send_json(None)
+        else:
+            self.send_error(404)
+
+def start_server(library:FakeLibrary) -> ThreadingHTTPServer:
+    handler = type('LibraryHandler', (FakeHydrusHandler,), {'library': library})
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+# Every library size gets a fresh copy of the script, so nothing (services, indexes, metrics) carries over between them
+def load_script():
+    spec = importlib.util.spec_from_file_location('hydrus_transcode', SCRIPT_PATH)
+    script = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(script)
+    return script
+
+def run_timed(results:dict, name:str, function, verbose:bool):
+    output = contextlib.nullcontext() if verbose else contextlib.redirect_stdout(open(os.devnull, 'w'))
+    start = time.perf_counter()
+    with output:
+        value = function()
+    results[name] = time.perf_counter() - start
+    return value
+
+def benchmark_size(size:int, media:list[MediaFile], arguments) -> dict:
+    script = load_script()
+    work_folder = tempfile.mkdtemp(prefix=f'library-{size}-', dir=arguments.work_dir)
+    results = {'size': size}
+    try:
+        library = FakeLibrary(size, media, arguments.media_files, script.TRANSCODE_NAMESPACE, script.TRANSCODE_TAG_SERVICE, script.TRANSCODE_FILE_SERVICE)
+        run_timed(results, 'generate', lambda: library.write_client_files(f'{work_folder}/client_files'), arguments.verbose)
+        server = start_server(library)
+
+        script.client = hydrus_api.Client(access_key='benchmark', api_url=f'http://127.0.0.1:{server.server_address[1]}')
+        script.HYDRUS_DATA_PATH = f'{work_folder}/client_files'
+        script.CONVERSION_OUTPUT_PATH = f'{work_folder}/converted'
+        script.CONVERSION_TEMP_PATH = f'{work_folder}/converting'
+        script.STATE_DATABASE_PATH = ''
+        script.IMAGE_BACKEND = arguments.image_backend
+        script.MAX_JOBS = arguments.jobs
+        script.API_MAX_IN_FLIGHT = arguments.api_in_flight
+        os.makedirs(script.CONVERSION_OUTPUT_PATH)
+        os.makedirs(script.CONVERSION_TEMP_PATH)
+        script.configure_api_connections()
+        script.get_services()
+
+        transcode_index = run_timed(results, 'index', script.get_current_transcodes, arguments.verbose)
+        results['indexed'] = len(transcode_index)
+        run_timed(results, 'conversion', lambda: script.start_conversion(script.call_api('search_files', ['system:everything'], return_hashes=True)), arguments.verbose)
+        results['converted'] = len(os.listdir(script.CONVERSION_OUTPUT_PATH))
+        results['media'] = len(library.media)
+        run_timed(results, 'cleanup', script.cleanup_procedure, arguments.verbose)
+        results['deleted'] = len(library.deleted)
+        results['expected_deleted'] = library.get_expected_orphans()
+        results['requests'] = library.requests
+        server.shutdown()
+        server.server_close()
+        if arguments.profile:
+            print(f'Stages for library of {size} files:')
+            script.metrics.print_summary()
+    finally:
+        if not arguments.keep:
+            shutil.rmtree(work_folder, ignore_errors=True)
+    return results
+
+def print_results(all_results:list[dict]):
+    print(f"{'files':>9} {'generate[s]':>12} {'index[s]':>9} {'conversion[s]':>14} {'cleanup[s]':>11} {'converted':>10} {'deleted':>12} {'requests':>9}")
+    for results in all_results:
+        deleted = f"{results['deleted']}/{results['expected_deleted']}"
+        converted = f"{results['converted']}/{results['media']}"
+        print(f"{results['size']:>9} {results['generate']:>12.2f} {results['index']:>9.2f} {results['conversion']:>14.2f} {results['cleanup']:>11.2f} {converted:>10} {deleted:>12} {results['requests']:>9}")
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks hydrus-transcode against a local stand-in for hydrus client api with generated library. Reports time of the existence index, conversion pass and cleanup pass for every library size.')
+    parser.add_argument('--sizes',type=int,nargs='+',default=LIBRARY_SIZES,help=f'Library sizes (amount of original files) to benchmark. Default {LIBRARY_SIZES}.')
+    parser.add_argument('--media_files',type=int,default=MEDIA_FILES,help=f'How many files in every library are real images and videos that get converted. 0 skips encoding entirely. Default {MEDIA_FILES}.')
+    parser.add_argument('--work_dir',default=None,help='Where generated libraries are written. Defaults to system temp folder.')
+    parser.add_argument('--keep',action='store_true',help="Doesn't remove generated libraries and outputs.")
+    parser.add_argument('--image_backend',choices=['magick','pillow'],default='magick',help='Image backend the script uses. Default magick.')
+    parser.add_argument('--jobs',type=int,default=os.cpu_count(),help='How many files get converted at the same time.')
+    parser.add_argument('--api_in_flight',type=int,default=8,help='How many requests can be sent to the server at the same time. Default 8.')
+    parser.add_argument('--profile',action='store_true',help="Prints script's own per-stage summary for every library size.")
+    parser.add_argument('--verbose',action='store_true',help="Shows script's output instead of hiding it.")
+    arguments = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix='hydrus-transcode-media-', dir=arguments.work_dir) as media_folder:
+        media = []
+        if arguments.media_files > 0:
+            print('Generating media samples.')
+            media = generate_media_samples(media_folder)
+        all_results = []
+        for size in arguments.sizes:
+            print(f'Benchmarking library of {size} files.')
+            all_results.append(benchmark_size(size, media, arguments))
+    print_results(all_results)
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,36 @@
 import os
-import glob
+import io
+import re
+import copy
 import hydrus_api
+import requests
 import subprocess
 import argparse
+import threading
+import sqlite3
+import hashlib
+import json
+import time
+import signal
+import tempfile
+import shutil
+import contextlib
+# Locking is only available on unix, elsewhere the temp folder is cleaned without it
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+# Pillow is optional, it's only needed for --image_backend pillow
+try:
+    from PIL import Image, features
+except ImportError:
+    Image = None
+# Color management is used to turn CMYK images into sRGB, Pillow can be built without it
+try:
+    from PIL import ImageCms
+except ImportError:
+    ImageCms = None
 
 ###################################################################
 ############ CONFIG SECTION - THIS IS WHERE YOU CAN CHANGE STUFF ##
@@ -23,6 +51,11 @@ TRANSCODE_TAG_SERVICE = '6c6f63616c2074616773'
 # Setting this to true will always re-encode and overwrite all the given files
 # Should really only be used when changing settings of encoding, as it will allow for quick replace of all files
 OVERWRITE_EXISTING_FILES=False
+# Setting this to true re-encodes only files whose transcode was made with different settings than the current ones
+REENCODE_STALE_FILES=False
+# Namespace holding fingerprint of settings used to make a transcode, saved as <TRANSCODE_SETTINGS_NAMESPACE>:<fingerprint>
+# It's what REENCODE_STALE_FILES compares against, '' disables tagging
+TRANSCODE_SETTINGS_NAMESPACE = 'transcode-settings'
 # Your API access key
 HYDRUS_ACCESS_KEY = ''
 ####################
@@ -34,6 +67,80 @@ HYDRUS_DATA_PATH = ''
 # This is location of output of conversion
 # For most automation you can add this folder as import folder to hydrus
 CONVERSION_OUTPUT_PATH = './converted'
+# Files are written here first and moved into CONVERSION_OUTPUT_PATH only once finished, so import folder never picks up half written files
+# Keep it outside of CONVERSION_OUTPUT_PATH, but on the same disk, so moving is instant
+CONVERSION_TEMP_PATH = './converting'
+###############
+# Parallelism #
+###############
+# How many files get converted at the same time, by default it's the amount of cores in the machine
+MAX_JOBS = os.cpu_count() or 1
+# Separate limits for image (magick) and video (ffmpeg) jobs, they are both capped by MAX_JOBS anyway
+# ffmpeg already uses few threads per job by itself, so running too many of them at once doesn't help much
+MAX_IMAGE_JOBS = MAX_JOBS
+MAX_VIDEO_JOBS = max(1, MAX_JOBS // 4)
+# Chunked video encoding - videos longer than SEGMENT_MIN_DURATION seconds get split at keyframes into pieces of about SEGMENT_LENGTH seconds
+# Up to SEGMENT_JOBS pieces are encoded at the same time and joined back together without re-encoding
+# Only works for webm output, set SEGMENT_MIN_DURATION to 0 to disable it
+SEGMENT_MIN_DURATION = 30
+SEGMENT_LENGTH = 10
+SEGMENT_JOBS = max(1, MAX_JOBS // 2)
+##############
+# Scheduling #
+##############
+# How much memory (in bytes) conversions running at the same time may use together, by default half of the machine's memory
+# Memory needed by a job is estimated from resolution, amount of frames and duration, a job larger than whole budget still runs but alone
+MEMORY_BUDGET = (os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') // 2) if hasattr(os, 'sysconf') else 8 * 1024 * 1024 * 1024
+# Resource limits passed to every magick process, so a single huge file can't take over the machine ('' leaves magick's default)
+# Above memory limit magick moves pixel cache to disk, which is slower but doesn't crash
+MAGICK_MEMORY_LIMIT = '1GiB'
+MAGICK_MAP_LIMIT = '2GiB'
+# Jobs get sorted by worth (see order_jobs) in windows of this many times MAX_JOBS, and about that many wait in the pools
+# Larger windows sort better, but first conversion starts later and more of the search is held in memory
+JOB_WINDOW = 4
+# Rough speeds used to estimate how long a job will take, they only decide order of jobs so they don't have to be exact
+IMAGE_PIXELS_PER_SECOND = 20_000_000
+VIDEO_PIXELS_PER_SECOND = 3_000_000
+# Rough expected output size compared to original, used to guess how much a job will save
+EXPECTED_IMAGE_SIZE_RATIO = 0.3
+EXPECTED_VIDEO_SIZE_RATIO = 0.5
+# What encodes images
+# 'magick' - starts a magick process for every file
+# 'pillow' - encodes inside long living worker processes, saves process startup on every file, needs Pillow with webp support
+# Formats pillow can't handle (gifs) and files it fails on still go through magick
+IMAGE_BACKEND = 'magick'
+#############
+# API calls #
+#############
+# How many hashes are sent in a single metadata request, too large values make hydrus time out
+METADATA_CHUNK_SIZE = 256
+# How many hashes are sent in a single delete request
+DELETE_CHUNK_SIZE = 1000
+# How many requests can be waiting on hydrus at the same time, for remote instances higher values hide more of the network latency
+API_MAX_IN_FLIGHT = 8
+# How many times a request is sent again when hydrus is busy or unreachable, waiting API_RETRY_DELAY seconds and twice as long after every next try
+API_RETRIES = 5
+API_RETRY_DELAY = 0.5
+###############
+# Local state #
+###############
+# Local database remembering which files were already processed, so following runs can skip them without asking hydrus
+# Set to '' to disable it
+STATE_DATABASE_PATH = './hydrus-transcode.db'
+###############
+# Daemon mode #
+###############
+# How often (in seconds) hydrus gets asked for new files when running with --daemon
+DAEMON_POLL_INTERVAL = 300
+# How many times a failing file gets tried (across runs, see --resume) before it's given up on
+JOB_MAX_ATTEMPTS = 3
+###########
+# Metrics #
+###########
+# Every processed file gets a line with its stage timings, sizes and encoder speed in this file ('' disables it)
+METRICS_JSONL_PATH = ''
+# Totals in Prometheus text format, meant for node_exporter textfile collector ('' disables it)
+METRICS_PROMETHEUS_PATH = ''
 # Those are default settings
 class ImageSettings:
     # Quality of encoding, for good quality to size ratio values of 50-75 recommended for webp, higher values give higher quality
@@ -46,6 +153,11 @@ class ImageSettings:
     # This should stay
     width = 1920
     height = 1920
+    # Adaptive quality targets, when any of them is set quality above is searched for with trial encodes instead (None disables)
+    # Max size of output in bytes per pixel
+    target_bytes_per_pixel = None
+    # Lowest SSIM (1 = identical) output may have compared to the resized original
+    target_ssim = None
 class VideoSettings:
     # This by default represents CRF value, which to get good quality 1080p video is recommended to be kept around 30-36, lower values give better quality
     quality = 35
@@ -60,6 +172,10 @@ class VideoSettings:
     # Files longer than max_duration won't get converted
     min_duration = 0 #seconds
     max_duration = 60 #seconds
+    # Adaptive quality targets, same as for images (None disables)
+    # Max bitrate of video stream in kbit/s
+    target_bitrate = None
+    target_ssim = None
 
 
 IMAGE_SETTINGS_JPG = ImageSettings()
@@ -69,13 +185,50 @@ IMAGE_SETTINGS_PNG = ImageSettings()
 IMAGE_SETTINGS_GIF = ImageSettings()
 VIDEO_SETTINGS_GIF = VideoSettings()
 VIDEO_SETTINGS_GIF.type = 'webp'
+VIDEO_SETTINGS = VideoSettings()
+# Rendition ladder - when not empty, every video gets converted into all of those settings at once
+# Source is decoded only once and split between the renditions, which is a lot cheaper than converting it again for each of them
+# Renditions not smaller than the source get dropped (only one copy in original size is kept)
+# ex.
+# VIDEO_SETTINGS_360 = VideoSettings()
+# VIDEO_SETTINGS_360.width = 640
+# VIDEO_SETTINGS_360.height = 640
+# VIDEO_LADDER = [VIDEO_SETTINGS, VIDEO_SETTINGS_360]
+VIDEO_LADDER = []
+# Each rendition gets tagged with <TRANSCODE_RENDITION_NAMESPACE>:<width>x<height> besides <TRANSCODE_NAMESPACE>:<hash>
+TRANSCODE_RENDITION_NAMESPACE = f'{TRANSCODE_NAMESPACE}-rendition'
+
+# Files that are already within resize bounds and smaller than those limits won't get converted, there is little to gain from them
+# Images - size in bytes
+MIN_IMAGE_SIZE = 100 * 1024
+# Videos - bitrate in kbit/s
+MIN_VIDEO_BITRATE = 2000
+# Outputs that aren't smaller than the original by at least this part of its size get dropped, they would only waste bandwidth
+# Set to None to keep every output, even ones larger than the original
+# Only works with STATE_DATABASE_PATH set, without it nothing would remember a dropped output and the file would be searched and encoded again every run
+MIN_OUTPUT_SAVING = 0.05
+
+####################
+# Adaptive quality #
+####################
+# Used for settings with a target set (ex. IMAGE_SETTINGS_JPG.target_bytes_per_pixel = 0.15 or VIDEO_SETTINGS.target_ssim = 0.95)
+# Quality is searched for with trial encodes on a small sample of the file, then the file gets encoded once with the found quality
+# With a size target and SSIM floor together, lowest quality passing the floor is used, as long as it fits the size
+# Range of qualities searched through as (worst, best)
+ADAPTIVE_IMAGE_QUALITY_RANGE = (30, 95)
+# For videos this is CRF, so lower is better
+ADAPTIVE_VIDEO_QUALITY_RANGE = (50, 20)
+# Image trials are done on a square from the middle of the resized image, this is its side in pixels
+ADAPTIVE_IMAGE_SAMPLE_SIZE = 512
+# Video trials are done on this many seconds from the middle of the video
+ADAPTIVE_VIDEO_SAMPLE_DURATION = 3
 
 
 
 ##################################################################################
 # I don't see option to not log the file deletion, which I assume means that if for whatever reason you might want the old one it will not import it without some shenanings inside hydrus itself
 
-# IDEA #2 - Transcode service
+# IDEA #2 - Transcode service (available as --daemon)
 # Run a permanent "service" that will under some given settings query hydrus every now and then like this
 # Give me all files with 'x' search result
 # Check if all of them have their transcode
@@ -91,47 +244,682 @@ VIDEO_SETTINGS_GIF.type = 'webp'
 
 client = hydrus_api.Client()
 client.access_key = HYDRUS_ACCESS_KEY
+# Errors after which it makes sense to ask again, hydrus answers with DatabaseLocked while it's busy
+RETRYABLE_API_ERRORS = tuple(error for error in (getattr(hydrus_api, 'DatabaseLocked', None), requests.ConnectionError, requests.Timeout) if error is not None)
 total_bytes_saved = 0
+# Workers finish in random order, so every change to total_bytes_saved has to go through this lock
+total_bytes_saved_lock = threading.Lock()
 setting_do_cleanup = False
 setting_do_search = False
 setting_search_arguments=[]
 setting_skip_movies=False
+setting_daemon=False
+setting_resume=False
+setting_profile=False
+state_database = None
+# Lock on CONVERSION_TEMP_PATH held for the whole run, only the run holding it cleans the folder
+temp_folder_lock = None
+# transcode hash => fingerprint of settings it was made with, filled by get_current_transcodes
+transcode_fingerprints:dict[str,str] = {}
+
+# Possible outcomes of conversion of a single file, those get saved in the state database
+RESULT_CONVERTED = 'converted'
+# Also used for outputs not smaller than the original by MIN_OUTPUT_SAVING, those get dropped
+RESULT_LARGER = 'larger_than_original'
+RESULT_SKIPPED_DURATION = 'skipped_duration'
+RESULT_SKIPPED_SMALL = 'skipped_small'
+RESULT_SKIPPED_UNSUPPORTED = 'skipped_unsupported'
+RESULT_FAILED = 'failed'
+
+# Job states kept in the journal
+JOB_RUNNING = 'running'
+JOB_DONE = 'done'
+JOB_FAILED = 'failed'
+JOB_QUEUED = 'queued'
+
+class ConversionResult:
+    def __init__(self,result:str,output_path:str=None,options=None,error:str=None):
+        self.result:str = result
+        # What went wrong, only for failed conversions
+        self.error:str = error
+        self.output_path:str = output_path
+        # ImageSettings/VideoSettings used for the conversion
+        self.options = options
+        self.transcode_hash:str = None
+        # Hashes of all outputs, more than one only for rendition ladder
+        self.transcode_hashes:list[str] = []
+        self.output_size:int = None
+        # Only for rendition ladder - label => output path of every rendition, output_path is the first one of them
+        self.renditions:dict[str,str] = {}
+        # Extension and size of the original, they decide which settings apply to it
+        self.extension:str = None
+        self.original_size:int = None
+
+# What hydrus already knows about a file, any of the values can be None if hydrus didn't report it
+class FileInfo:
+    def __init__(self,response):
+        self.extension:str = response.get('ext')
+        self.mime:str = response.get('mime')
+        self.size:int = response.get('size')
+        self.width:int = response.get('width')
+        self.height:int = response.get('height')
+        # Hydrus reports duration in milliseconds
+        duration = response.get('duration')
+        self.duration:float = duration / 1000 if duration is not None else None
+        self.frames:int = response.get('num_frames')
+
+# Estimated resources a job will need, used to keep memory in budget and to run most worthwhile jobs first
+class JobCost:
+    def __init__(self,memory:int,cpu_seconds:float,expected_saving:int,slots:int=1):
+        self.memory:int = memory
+        self.cpu_seconds:float = cpu_seconds
+        self.expected_saving:int = expected_saving
+        # How many of MAX_JOBS the job takes, segmented videos and ladders run several encoders at once
+        self.slots:int = slots
+
+    # Bytes saved per second of work, higher goes first
+    def priority(self) -> float:
+        return self.expected_saving / max(self.cpu_seconds, 0.001)
+
+class MemoryBudget:
+    def __init__(self,budget:int):
+        self.budget:int = budget
+        self.used:int = 0
+        self.condition = threading.Condition()
+
+    def acquire(self,amount:int):
+        with self.condition:
+            # Job larger than whole budget would never fit, so it waits until nothing else runs
+            while self.used > 0 and self.used + amount > self.budget:
+                self.condition.wait()
+            self.used += amount
+
+    def release(self,amount:int):
+        with self.condition:
+            self.used -= amount
+            self.condition.notify_all()
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        # stage => [total seconds, count, longest]
+        self.stages:dict[str,list] = {}
+        # format (ex. .jpg->webp) => [files, input bytes, output bytes, encode seconds, frames]
+        self.formats:dict[str,list] = {}
+        self.jsonl_file = None
+
+    def open_jsonl(self,path:str):
+        self.jsonl_file = open(path, 'a')
+
+    def add_stage(self,stage:str,seconds:float,record:dict=None):
+        with self.lock:
+            totals = self.stages.setdefault(stage, [0.0, 0, 0.0])
+            totals[0] += seconds
+            totals[1] += 1
+            totals[2] = max(totals[2], seconds)
+            if record is not None:
+                record['stages'][stage] = record['stages'].get(stage, 0) + seconds
+
+    # Saves finished file record, encoder speed and size ratio get calculated here
+    def add_file(self,record:dict):
+        encode_seconds = record['stages'].get('encode', 0)
+        if encode_seconds and record.get('output_size'):
+            record['encode_mb_per_second'] = record['input_size'] / (1024 * 1024) / encode_seconds
+            if record.get('frames'):
+                record['encode_fps'] = record['frames'] / encode_seconds
+            record['size_ratio'] = record['output_size'] / record['input_size'] if record['input_size'] else None
+        with self.lock:
+            if record.get('output_size'):
+                totals = self.formats.setdefault(record['format'], [0, 0, 0, 0.0, 0])
+                totals[0] += 1
+                totals[1] += record['input_size']
+                totals[2] += record['output_size']
+                totals[3] += encode_seconds
+                totals[4] += record.get('frames') or 0
+            if self.jsonl_file is not None:
+                self.jsonl_file.write(json.dumps(record) + '\n')
+                self.jsonl_file.flush()
+
+    def write_prometheus(self,path:str):
+        with self.lock:
+            lines = ['# TYPE hydrus_transcode_stage_seconds_total counter']
+            lines += [f'hydrus_transcode_stage_seconds_total{{stage="{stage}"}} {totals[0]}' for stage, totals in self.stages.items()]
+            lines += ['# TYPE hydrus_transcode_stage_calls_total counter']
+            lines += [f'hydrus_transcode_stage_calls_total{{stage="{stage}"}} {totals[1]}' for stage, totals in self.stages.items()]
+            for index, name in enumerate(['files', 'input_bytes', 'output_bytes', 'encode_seconds', 'frames']):
+                lines += [f'# TYPE hydrus_transcode_format_{name}_total counter']
+                lines += [f'hydrus_transcode_format_{name}_total{{format="{format}"}} {totals[index]}' for format, totals in self.formats.items()]
+            lines += ['# TYPE hydrus_transcode_bytes_saved_total counter', f'hydrus_transcode_bytes_saved_total {total_bytes_saved}']
+        # Collector could read half written file, so it gets written next to it and renamed
+        with open(f'{path}.tmp', 'w') as prometheus_file:
+            prometheus_file.write('\n'.join(lines) + '\n')
+        os.replace(f'{path}.tmp', path)
+
+    def print_summary(self):
+        with self.lock:
+            print('Stage            total[s]    calls   avg[ms]   max[ms]')
+            for stage, (total, count, longest) in sorted(self.stages.items(), key=lambda item: -item[1][0]):
+                print(f'{stage:<15} {total:>9.2f} {count:>8} {total / count * 1000:>9.1f} {longest * 1000:>9.1f}')
+            print('Format           files   size ratio      MB/s       fps')
+            for format, (files, input_bytes, output_bytes, encode_seconds, frames) in sorted(self.formats.items()):
+                speed = input_bytes / (1024 * 1024) / encode_seconds if encode_seconds else 0
+                fps = frames / encode_seconds if encode_seconds and frames else 0
+                print(f'{format:<15} {files:>6} {output_bytes / input_bytes if input_bytes else 0:>12.3f} {speed:>9.2f} {fps:>9.1f}')
+
+    def close(self):
+        if self.jsonl_file is not None:
+            self.jsonl_file.close()
+            self.jsonl_file = None
+
+metrics = Metrics()
+
+# Prometheus file is rewritten at the end of the run and after every daemon poll
+def export_metrics():
+    if METRICS_PROMETHEUS_PATH:
+        metrics.write_prometheus(METRICS_PROMETHEUS_PATH)
+# Record of the file current worker thread is converting, stage timings get added to it
+job_metrics = threading.local()
+
+# Times a stage of the work, it counts towards totals and towards given (or current thread's) file record
+@contextlib.contextmanager
+def time_stage(stage:str, record:dict=None):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.add_stage(stage, time.perf_counter() - start, record if record is not None else getattr(job_metrics, 'record', None))
+
+class StateDatabase:
+    def __init__(self,path:str):
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        # Every original file this script processed and what came out of it
+        self.connection.execute('CREATE TABLE IF NOT EXISTS files (original_hash TEXT PRIMARY KEY, transcode_hash TEXT, output_size INTEGER, settings TEXT, result TEXT, updated INTEGER)')
+        # Copy of transcode file service contents, so it only has to be updated with what changed since last run
+        self.connection.execute('CREATE TABLE IF NOT EXISTS transcodes (transcode_hash TEXT PRIMARY KEY, original_hash TEXT, fingerprint TEXT)')
+        # Databases made before fingerprints were tracked
+        transcode_columns = [row[1] for row in self.connection.execute('PRAGMA table_info(transcodes)')]
+        if 'fingerprint' not in transcode_columns:
+            self.connection.execute('ALTER TABLE transcodes ADD COLUMN fingerprint TEXT')
+        # Databases made before skipped files were checked against current settings
+        file_columns = [row[1] for row in self.connection.execute('PRAGMA table_info(files)')]
+        for column, type in (('extension', 'TEXT'), ('original_size', 'INTEGER'), ('plan', 'TEXT')):
+            if column not in file_columns:
+                self.connection.execute(f'ALTER TABLE files ADD COLUMN {column} {type}')
+        # Files waiting for conversion in daemon mode, they stay here until finished so nothing gets lost on restart
+        self.connection.execute('CREATE TABLE IF NOT EXISTS queue (original_hash TEXT PRIMARY KEY, added INTEGER)')
+        # Journal of conversion jobs, a job still marked as running after a crash is what --resume picks up
+        self.connection.execute('CREATE TABLE IF NOT EXISTS jobs (original_hash TEXT PRIMARY KEY, state TEXT, attempts INTEGER, error TEXT, updated INTEGER)')
+        self.connection.commit()
 
+    # Hashes which don't need to be looked at again, failed ones get another try until they run out of attempts
+    # Skipped and dropped files are looked at again once settings or thresholds that decided their fate change
+    def get_done_hashes(self) -> set[str]:
+        rows = self.connection.execute('SELECT original_hash, result, extension, original_size, plan FROM files WHERE result != ?', (RESULT_FAILED,))
+        done_hashes = set()
+        # id of settings object => its current plan fingerprint, so every settings object is fingerprinted only once
+        current_plans:dict[int,str] = {}
+        for hash, result, extension, size, plan in rows:
+            if result != RESULT_CONVERTED:
+                options = get_conversion_settings(extension, size or 0)
+                if id(options) not in current_plans:
+                    current_plans[id(options)] = get_plan_fingerprint(options)
+                if plan != current_plans[id(options)]:
+                    continue
+            done_hashes.add(hash)
+        rows = self.connection.execute('SELECT original_hash FROM jobs WHERE state = ? AND attempts >= ?', (JOB_FAILED, JOB_MAX_ATTEMPTS))
+        done_hashes.update(row[0] for row in rows)
+        return done_hashes
 
+    # Marks job as started, every start counts as an attempt
+    def start_job(self,hash:str):
+        self.connection.execute('INSERT INTO jobs VALUES (?,?,1,NULL,?) ON CONFLICT(original_hash) DO UPDATE SET state = excluded.state, attempts = attempts + 1, updated = excluded.updated', (hash, JOB_RUNNING, int(time.time())))
+        self.connection.commit()
 
-def find_file_in_data(file_hash):
-    file_path = f"{HYDRUS_DATA_PATH}/f{file_hash[0:2]}/{file_hash}"
-    files = glob.glob(f'{file_path}*')
+    def finish_job(self,hash:str,state:str,error:str=None):
+        self.connection.execute('UPDATE jobs SET state = ?, error = ?, updated = ? WHERE original_hash = ?', (state, error, int(time.time()), hash))
+        self.connection.commit()
+
+    # Job that was submitted but never started, it gets its attempt back
+    def cancel_job(self,hash:str):
+        self.connection.execute('UPDATE jobs SET state = ?, attempts = attempts - 1, updated = ? WHERE original_hash = ?', (JOB_QUEUED, int(time.time()), hash))
+        self.connection.commit()
+
+    # Jobs interrupted by a crash and failed ones that still have attempts left
+    def get_resumable_jobs(self) -> list[str]:
+        rows = self.connection.execute('SELECT original_hash FROM jobs WHERE state IN (?,?) OR (state = ? AND attempts < ?) ORDER BY updated', (JOB_RUNNING, JOB_QUEUED, JOB_FAILED, JOB_MAX_ATTEMPTS))
+        return [row[0] for row in rows]
+
+    def record_result(self,hash:str,conversion:ConversionResult):
+        settings = get_settings_json(conversion.options) if conversion.options else None
+        # Results without known extension (failed before conversion started) get no plan, so they are never skipped because of it
+        plan = get_plan_fingerprint(get_conversion_settings(conversion.extension, conversion.original_size or 0)) if conversion.extension is not None else None
+        self.connection.execute('INSERT OR REPLACE INTO files (original_hash, transcode_hash, output_size, settings, result, updated, extension, original_size, plan) VALUES (?,?,?,?,?,?,?,?,?)',
+                                (hash, conversion.transcode_hash, conversion.output_size, settings, conversion.result, int(time.time()), conversion.extension, conversion.original_size, plan))
+        self.connection.commit()
+
+    # Fingerprint of settings last used to convert given file, None if it wasn't converted by this script
+    def get_settings_fingerprint(self,hash:str) -> str:
+        row = self.connection.execute('SELECT settings FROM files WHERE original_hash = ? AND result IN (?,?)', (hash, RESULT_CONVERTED, RESULT_LARGER)).fetchone()
+        if row is None or row[0] is None:
+            return None
+        return get_fingerprint_from_json(row[0])
+
+    def forget_files(self,hashes:list[str]):
+        self.connection.executemany('DELETE FROM files WHERE original_hash = ?', [(hash,) for hash in hashes])
+        self.connection.commit()
+
+    def get_known_transcodes(self) -> set[str]:
+        return {row[0] for row in self.connection.execute('SELECT transcode_hash FROM transcodes')}
+
+    # Rows of (transcode hash, original hash, settings fingerprint)
+    def add_transcodes(self,rows:list[tuple[str,str,str]]):
+        self.connection.executemany('INSERT OR REPLACE INTO transcodes VALUES (?,?,?)', rows)
+        self.connection.commit()
+
+    # Removes transcodes that are gone from hydrus, returns originals they belonged to
+    def remove_transcodes(self,hashes:list[str]) -> list[str]:
+        originals = []
+        for chunk in split_into_chunks(hashes, 500):
+            placeholders = ','.join('?' * len(chunk))
+            originals.extend(row[0] for row in self.connection.execute(f'SELECT original_hash FROM transcodes WHERE transcode_hash IN ({placeholders})', chunk))
+            self.connection.execute(f'DELETE FROM transcodes WHERE transcode_hash IN ({placeholders})', chunk)
+        self.connection.commit()
+        return [original for original in originals if original != '']
+
+    def get_transcode_rows(self) -> list[tuple[str,str,str]]:
+        return self.connection.execute('SELECT transcode_hash, original_hash, fingerprint FROM transcodes').fetchall()
+
+    def enqueue(self,hashes:list[str]):
+        added = int(time.time())
+        self.connection.executemany('INSERT OR IGNORE INTO queue VALUES (?,?)', [(hash, added) for hash in hashes])
+        self.connection.commit()
+
+    def get_queued(self,limit:int=-1) -> list[str]:
+        return [row[0] for row in self.connection.execute('SELECT original_hash FROM queue ORDER BY added, rowid LIMIT ?', (limit,))]
+
+    def dequeue(self,hash:str):
+        self.connection.execute('DELETE FROM queue WHERE original_hash = ?', (hash,))
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+
+
+class DataFolderIndex:
+    def __init__(self):
+        # folder prefix => {hash: names of files starting with that hash}
+        self.folders:dict[str,dict[str,list[str]]] = {}
+        # Prefixes listed since last refresh, misses in those are real and don't list the folder again
+        self.fresh:set[str] = set()
+        self.lock = threading.Lock()
+
+    # Lets every folder be listed once more, daemon calls this on each poll so files imported since then can be found
+    def refresh(self):
+        with self.lock:
+            self.fresh.clear()
+
+    # Lists a single fXX folder, every folder gets listed at most once per refresh
+    def load_folder(self,prefix:str) -> dict[str,list[str]]:
+        entries:dict[str,list[str]] = {}
+        try:
+            with os.scandir(f"{HYDRUS_DATA_PATH}/f{prefix}") as iterator:
+                for entry in iterator:
+                    entries.setdefault(entry.name.split('.', 1)[0], []).append(entry.name)
+        except FileNotFoundError:
+            pass
+        self.folders[prefix] = entries
+        self.fresh.add(prefix)
+        return entries
+
+    def get_files(self,file_hash:str) -> list[str]:
+        prefix = file_hash[0:2]
+        with self.lock:
+            entries = self.folders.get(prefix)
+            if entries is None:
+                entries = self.load_folder(prefix)
+            names = entries.get(file_hash)
+            # File might have been imported after folder was listed (daemon mode), so list it again, but only once per refresh
+            # Files stored in other locations or missing ones would otherwise list whole folder on every lookup
+            if names is None and prefix not in self.fresh:
+                names = self.load_folder(prefix).get(file_hash)
+        return [f"{HYDRUS_DATA_PATH}/f{prefix}/{name}" for name in names or []]
+
+data_folder_index = DataFolderIndex()
+
+def find_file_in_data(file_hash, extension:str=None):
+    # Hydrus names files <hash><ext>, so when extension is known from metadata there is no need to list the folder
+    if extension:
+        file_path = f"{HYDRUS_DATA_PATH}/f{file_hash[0:2]}/{file_hash}{extension}"
+        if os.path.isfile(file_path):
+            return file_path
+    files = data_folder_index.get_files(file_hash)
     if len(files) > 1:
         print(f'Something went really wrong, there should be only 1 file with a hash name. For safety aborting.')
         print(f'Problematic file : {files}')
-    else:
+    elif len(files) == 1:
         return files[0]  # There should be only one file
 
-def convert_using_magick(path: str, options: ImageSettings, hash: str):
+def add_bytes_saved(difference: int):
     global total_bytes_saved
+    with total_bytes_saved_lock:
+        total_bytes_saved += difference
+
+# Settings that only decide which files get converted, they don't change how the output looks
+FILTER_ONLY_SETTINGS = {'min_duration', 'max_duration'}
+
+# Returns all setting values of ImageSettings/VideoSettings object, including ones left at class defaults
+# Rendition ladder (list of settings) gives list of values
+# Unset (None) values are left out, so fingerprints don't change when new optional settings get added
+# Filter only settings are left out unless include_filters is set, so allowing more files in doesn't make every transcode stale
+def get_settings_values(options, include_filters:bool=False):
+    if isinstance(options, list):
+        return [get_settings_values(entry, include_filters) for entry in options]
+    values = {}
+    for name in dir(options):
+        if name.startswith('_') or (name in FILTER_ONLY_SETTINGS and not include_filters):
+            continue
+        value = getattr(options, name)
+        if not callable(value) and value is not None:
+            values[name] = value
+    return values
+
+def get_settings_json(options, include_filters:bool=False) -> str:
+    return json.dumps(get_settings_values(options, include_filters), sort_keys=True)
+
+def get_fingerprint_from_json(settings_json: str) -> str:
+    return hashlib.sha256(settings_json.encode()).hexdigest()[:16]
+
+# Short hash of all values that affect the output, changes whenever any setting changes
+def get_settings_fingerprint(options, include_filters:bool=False) -> str:
+    return get_fingerprint_from_json(get_settings_json(options, include_filters))
+
+# Fingerprint of everything deciding whether file gets skipped or its output dropped - settings that apply to it and thresholds
+def get_plan_fingerprint(options) -> str:
+    plan = {
+        'settings': get_settings_values(get_effective_settings(options), include_filters=True) if options is not None else None,
+        'min_image_size': MIN_IMAGE_SIZE,
+        'min_video_bitrate': MIN_VIDEO_BITRATE,
+        'min_output_saving': MIN_OUTPUT_SAVING,
+        'adaptive_ranges': [ADAPTIVE_IMAGE_QUALITY_RANGE, ADAPTIVE_VIDEO_QUALITY_RANGE],
+    }
+    return get_fingerprint_from_json(json.dumps(plan, sort_keys=True))
+
+# Hydrus identifies files by sha256 of their content
+def get_file_hash(path: str) -> str:
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(1024 * 1024), b''):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+# Outputs are written into CONVERSION_TEMP_PATH and only moved into CONVERSION_OUTPUT_PATH when finished
+def get_temp_output_path(file_name: str) -> str:
+    return f'{CONVERSION_TEMP_PATH}/{file_name}'
+
+def publish_output(temp_path: str) -> str:
+    output_path = f'{CONVERSION_OUTPUT_PATH}/{os.path.basename(temp_path)}'
+    # On the same disk this is a rename, so the file appears in output folder all at once
+    shutil.move(temp_path, output_path)
+    return output_path
+
+def discard_outputs(temp_paths: list[str]):
+    for temp_path in temp_paths:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+# Removes whatever got written and returns failed result, last part of process output is kept as error
+def fail_conversion(temp_paths: list[str], options, error: str):
+    discard_outputs(temp_paths)
+    return ConversionResult(RESULT_FAILED, None, options, error.strip()[-1000:])
+
+# Outputs in temp folder are named <hash>.<type> or <hash>.<label>.<type>, anything else there isn't ours to touch
+TEMP_OUTPUT_PATTERN = re.compile(r'[0-9a-f]{64}\..+')
+
+# Removes outputs left in temp folder by a run that didn't finish
+# When another run (ex. daemon) holds the lock, its files are being worked on and are left alone
+def clean_temp_folder():
+    global temp_folder_lock
+    if fcntl is not None:
+        temp_folder_lock = open(f'{CONVERSION_TEMP_PATH}/.hydrus-transcode.lock', 'w')
+        try:
+            fcntl.flock(temp_folder_lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            print(f'Another run is using {CONVERSION_TEMP_PATH}, not removing its files.')
+            temp_folder_lock.close()
+            temp_folder_lock = None
+            return
+    with os.scandir(CONVERSION_TEMP_PATH) as iterator:
+        leftovers = [entry.path for entry in iterator if entry.is_file() and TEMP_OUTPUT_PATTERN.fullmatch(entry.name)]
+    if leftovers:
+        print(f'Removing {len(leftovers)} unfinished files from {CONVERSION_TEMP_PATH}.')
+        discard_outputs(leftovers)
+
+# Measures finished output and moves it into output folder, outputs not worth keeping are dropped
+def finish_output(path: str, temp_path: str, options, hash: str):
+    result = measure_savings(path, temp_path, hash)
+    if result == RESULT_LARGER:
+        print(f'Transcode of {hash} is not smaller than original by at least {MIN_OUTPUT_SAVING:.0%}, dropping it.')
+        discard_outputs([temp_path])
+        return ConversionResult(result, None, options)
+    # Import folder might take the file as soon as it's published, so it's measured while still in temp folder
+    transcode_hash, output_size = get_output_hash_and_size(temp_path)
+    conversion = ConversionResult(result, publish_output(temp_path), options)
+    conversion.transcode_hash = transcode_hash
+    conversion.transcode_hashes = [transcode_hash]
+    conversion.output_size = output_size
+    return conversion
+
+def get_output_hash_and_size(temp_path: str):
+    with time_stage('hash'):
+        return get_file_hash(temp_path), os.stat(temp_path).st_size
+
+# Compares sizes of original and converted file, output that doesn't save at least MIN_OUTPUT_SAVING counts as larger
+def measure_savings(path: str, output_path: str, hash: str, count_saving: bool = True) -> str:
+    with time_stage('stat'):
+        original_size = os.stat(path).st_size
+        transcoded_size = os.stat(output_path).st_size
+    difference = original_size - transcoded_size
+    print(f'{hash} smaller by {(difference) / 1024}KB')
+    # Without state database dropped output isn't remembered anywhere, so it's kept instead of being made again next run
+    if MIN_OUTPUT_SAVING is not None and state_database is not None and difference < original_size * MIN_OUTPUT_SAVING:
+        return RESULT_LARGER
+    if count_saving:
+        add_bytes_saved(difference)
+    return RESULT_CONVERTED
+
+# Returns qualities from worst to best for (worst, best) range
+def get_quality_candidates(quality_range: tuple[int,int]) -> list[int]:
+    worst, best = quality_range
+    step = 1 if best >= worst else -1
+    return list(range(worst, best + step, step))
+
+# Binary search for first index where predicate is true, predicate has to be false for all indexes before it and true after
+def find_first(count: int, predicate) -> int:
+    low, high = 0, count
+    while low < high:
+        middle = (low + high) // 2
+        if predicate(middle):
+            high = middle
+        else:
+            low = middle + 1
+    return low
+
+# trial(quality) encodes a sample and returns its size (bytes per pixel or bitrate) and SSIM
+# Returns chosen quality and number of trial encodes it took, every quality is tried at most once
+def search_quality(candidates: list[int], trial, max_size: float = None, min_ssim: float = None):
+    trials = {}
+    def get_trial(index: int):
+        if index not in trials:
+            trials[index] = trial(candidates[index])
+        return trials[index]
+    best = len(candidates) - 1
+    if min_ssim is not None:
+        # Worst quality that still looks good enough, best one if none does
+        best = min(find_first(len(candidates), lambda index: get_trial(index)[1] >= min_ssim), best)
+    if max_size is not None:
+        # Best quality that still fits, worst one if none does
+        best = min(best, max(find_first(len(candidates), lambda index: get_trial(index)[0] > max_size) - 1, 0))
+    return candidates[best], len(trials)
+
+# Returns SSIM of encoded file compared to reference (1 = identical), reference goes through reference_filter first so sizes match
+# Timestamps of both start from 0, otherwise a seeked reference gets compared with wrong frames
+def measure_ssim(encoded_path: str, reference_arguments: list[str], reference_filter: str) -> float:
+    filters = f'[0:v]setpts=PTS-STARTPTS[encoded];[1:v]{reference_filter},setpts=PTS-STARTPTS[reference];[encoded][reference]ssim'
+    process = subprocess.run(['ffmpeg','-i',encoded_path,*reference_arguments,'-lavfi',filters,'-f','null','-'],capture_output=True,text=True)
+    match = re.search(r'All:([0-9.]+)', process.stderr)
+    if process.returncode != 0 or match is None:
+        raise RuntimeError(f'Measuring SSIM failed: {process.stderr.strip()[-1000:]}')
+    return float(match.group(1))
+
+def is_adaptive(options) -> bool:
+    return any(getattr(options, name, None) is not None for name in ('target_bytes_per_pixel', 'target_bitrate', 'target_ssim'))
+
+# Returns copy of settings with quality found by find_quality, settings are returned unchanged when they have no targets or search fails
+# Settings objects are shared between workers, so they never get changed in place
+def get_adaptive_settings(options, hash: str, find_quality, *arguments):
+    if not is_adaptive(options):
+        return options
+    try:
+        quality, trials = find_quality(*arguments)
+    except (RuntimeError, OSError) as error:
+        print(f'Adaptive quality search failed for {hash}, using quality {options.quality}: {error}')
+        return options
+    print(f'Using quality {quality} for {hash}, found with {trials} trial encodes.')
+    record = getattr(job_metrics, 'record', None)
+    if record is not None:
+        record['quality'] = quality
+        record['trials'] = trials
+    adapted = copy.copy(options)
+    adapted.quality = quality
+    return adapted
+
+def get_magick_limits() -> list[str]:
+    limits = []
+    if MAGICK_MEMORY_LIMIT:
+        limits += ['-limit','memory',MAGICK_MEMORY_LIMIT]
+    if MAGICK_MAP_LIMIT:
+        limits += ['-limit','map',MAGICK_MAP_LIMIT]
+    return limits
+
+def convert_using_magick(path: str, options: ImageSettings, hash: str):
     #arguments = f'-quality {options.quality} -define {options.type} -resize {options.width}x{options.height}\>'
-    output_path = f'{CONVERSION_OUTPUT_PATH}/{hash}.{options.type}'
+    output_path = get_temp_output_path(f'{hash}.{options.type}')
     #command = f'magick {path} {arguments} {output_path}'
     #return_code = os.system(command)
-    return_code = subprocess.run(['magick',path,'-quality',str(options.quality),'-define',str(options.type),'-resize',f'{options.width}x{options.height}\>', output_path],capture_output=True,text=True)
+    with time_stage('encode'):
+        return_code = subprocess.run(['magick',*get_magick_limits(),path,'-quality',str(options.quality),'-define',str(options.type),'-resize',f'{options.width}x{options.height}\>', output_path],capture_output=True,text=True)
     if return_code.returncode != 0:
         print(f'Conversion error on {path}')
-        input()  # Waiting for user input
+        return fail_conversion([output_path], options, return_code.stderr)
 
     #Calculate savings if any
-    original_size = os.stat(path).st_size
-    transcoded_size = os.stat(output_path).st_size
-    difference = original_size - transcoded_size
-    total_bytes_saved += difference
+    return finish_output(path, output_path, options, hash)
 
-    print(f'File smaller by {(difference) / 1024}KB')
+# Extensions pillow backend handles, everything else goes through magick
+PILLOW_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+# Worker processes for pillow backend, created by ConversionWorkers
+pillow_pool = None
 
-    return output_path
+# Converts image into RGB/RGBA, CMYK with embedded profile is color managed into sRGB when possible
+def convert_pillow_mode(image, icc_profile: bytes):
+    if image.mode == 'CMYK' and icc_profile and ImageCms is not None:
+        try:
+            return ImageCms.profileToProfile(image, ImageCms.ImageCmsProfile(io.BytesIO(icc_profile)), ImageCms.createProfile('sRGB'), outputMode='RGB')
+        except (ImageCms.PyCMSError, OSError) as error:
+            print(f'Could not apply color profile, converting without it: {error}')
+    has_alpha = 'A' in image.mode or 'transparency' in image.info
+    return image.convert('RGBA' if has_alpha else 'RGB')
+
+# Runs inside pillow worker process, so it only gets plain values
+def encode_with_pillow(path: str, output_path: str, quality: int, type: str, resize: bool, width: int, height: int):
+    with Image.open(path) as image:
+        exif = image.info.get('exif')
+        icc_profile = image.info.get('icc_profile')
+        # Mode is changed before resizing, palette and bilevel images would be resized with NEAREST otherwise
+        if image.mode not in ('RGB', 'RGBA'):
+            image = convert_pillow_mode(image, icc_profile)
+            # Profile describes the old color space, it doesn't fit converted pixels
+            icc_profile = None
+        # Same as magick's -resize WxH> - only shrinks and keeps aspect ratio
+        if resize:
+            image.thumbnail((width, height))
+        save_options = {'quality': quality}
+        if exif:
+            save_options['exif'] = exif
+        if icc_profile:
+            save_options['icc_profile'] = icc_profile
+        image.save(output_path, format=type.upper(), **save_options)
+
+def convert_using_pillow(path: str, options: ImageSettings, hash: str):
+    output_path = get_temp_output_path(f'{hash}.{options.type}')
+    try:
+        with time_stage('encode'):
+            pillow_pool.submit(encode_with_pillow, path, output_path, options.quality, options.type, options.resize, options.width, options.height).result()
+    except Exception as error:
+        print(f'Pillow conversion error on {path}: {error}')
+        return fail_conversion([output_path], options, str(error))
+    return finish_output(path, output_path, options, hash)
+
+def uses_pillow(path: str) -> bool:
+    return IMAGE_BACKEND == 'pillow' and pillow_pool is not None and os.path.splitext(path)[1] in PILLOW_EXTENSIONS
+
+# Encodes sample the same way as the real conversion would, only with given quality and without resizing
+def encode_image_trial(path: str, sample_path: str, trial_path: str, options: ImageSettings, quality: int):
+    if uses_pillow(path):
+        try:
+            pillow_pool.submit(encode_with_pillow, sample_path, trial_path, quality, options.type, False, options.width, options.height).result()
+            return
+        except Exception as error:
+            print(f'Pillow trial encode error on {path}: {error}')
+    process = subprocess.run(['magick',*get_magick_limits(),sample_path,'-quality',str(quality),'-define',str(options.type),trial_path],capture_output=True,text=True)
+    if process.returncode != 0:
+        raise RuntimeError(f'Trial encode at quality {quality} failed: {process.stderr.strip()[-1000:]}')
+
+def find_image_quality(path: str, options: ImageSettings):
+    with tempfile.TemporaryDirectory(prefix='hydrus-transcode-') as temp_folder:
+        # Sample is cut from the resized image, so bytes per pixel and SSIM are close to what the full encode gets
+        sample_path = f'{temp_folder}/sample.png'
+        filters = []
+        if options.resize:
+            filters.append(f"scale=w='min({options.width},iw)':h='min({options.height},ih)':force_original_aspect_ratio=decrease")
+        filters.append(f"crop='min(iw,{ADAPTIVE_IMAGE_SAMPLE_SIZE})':'min(ih,{ADAPTIVE_IMAGE_SAMPLE_SIZE})'")
+        with time_stage('trial'):
+            process = subprocess.run(['ffmpeg','-y','-i',path,'-vf',','.join(filters),'-frames:v','1',sample_path],capture_output=True,text=True)
+        if process.returncode != 0:
+            raise RuntimeError(f'Making sample failed: {process.stderr.strip()[-1000:]}')
+        ffprobe_process = subprocess.run(['ffprobe','-v','error','-select_streams','v:0','-show_entries','stream=width,height','-of','csv=s=x:p=0',sample_path],capture_output=True,text=True)
+        width, height = ffprobe_process.stdout.strip().split('x')[:2]
+        pixels = int(width) * int(height)
+
+        def trial(quality: int):
+            trial_path = f'{temp_folder}/trial{quality}.{options.type}'
+            with time_stage('trial'):
+                encode_image_trial(path, sample_path, trial_path, options, quality)
+                ssim = measure_ssim(trial_path, ['-i',sample_path], 'null') if options.target_ssim is not None else None
+            return os.stat(trial_path).st_size / pixels, ssim
+        return search_quality(get_quality_candidates(ADAPTIVE_IMAGE_QUALITY_RANGE), trial, options.target_bytes_per_pixel, options.target_ssim)
+
+def convert_image(path: str, options: ImageSettings, hash: str):
+    encode_options = get_adaptive_settings(options, hash, find_image_quality, path, options)
+    conversion = None
+    if uses_pillow(path):
+        conversion = convert_using_pillow(path, encode_options, hash)
+        if conversion.result == RESULT_FAILED:
+            print(f'Falling back to magick for {path}')
+            conversion = None
+    if conversion is None:
+        conversion = convert_using_magick(path, encode_options, hash)
+    # Result keeps settings with targets, not the found quality, so fingerprint stays the same for all files
+    conversion.options = options
+    return conversion
 
 def get_video_file_info(path):
     # This is of course slightly naive as it only gets video 0 size, but it works for me
-    ffprobe_process = subprocess.run(['ffprobe', '-v', 'error', '-select_streams' ,'v:0', '-show_entries', 'format=duration : stream=width,height', '-of' ,'csv=s=x:p=0' ,f'{path}'],capture_output=True,text=True)
+    with time_stage('probe'):
+        ffprobe_process = subprocess.run(['ffprobe', '-v', 'error', '-select_streams' ,'v:0', '-show_entries', 'format=duration : stream=width,height', '-of' ,'csv=s=x:p=0' ,f'{path}'],capture_output=True,text=True)
     size = ffprobe_process.stdout.strip()
     #print(size)
     line_split = size.split('\n')
@@ -143,90 +931,288 @@ def get_video_file_info(path):
     print(f'Width:{width}\nHeight:{height}')
     return [width,height],duration
 
-def convert_using_ffmpeg(path: str, options: VideoSettings,hash:str):
+def get_video_dimensions_and_duration(path: str, file_info: FileInfo = None):
+    # ffprobe is only needed when hydrus didn't give us the values
+    if file_info is not None and None not in (file_info.width, file_info.height, file_info.duration):
+        return [file_info.width,file_info.height],file_info.duration
+    return get_video_file_info(path)
+
+# Returns ffmpeg scale filter shrinking video into options bounds, None if video already fits
+def get_scale_filter(options: VideoSettings, dimensions):
+    if not options.resize:
+        return None
+    if options.height >= int(dimensions[1]) and options.width >= int(dimensions[0]):
+        return None
+    # This makes sure that aspect ratio is kept
+    resize_settings=f'{options.width}:-1'
+    if int(dimensions[0]) < int(dimensions[1]):
+        resize_settings=f'-1:{options.height}'
+    return f'scale={resize_settings}'
+
+def get_rendition_label(options: VideoSettings) -> str:
+    return f'{options.width}x{options.height}'
+
+def convert_using_ffmpeg(path: str, options: VideoSettings,hash:str,file_info:FileInfo=None):
     # Given how videos are working on the web, video conversion really only make sense for videos that are too large in bit rate or resolution for mostly mobile devices to decode
     # From what i found, mobile phones usually decode video up to their screen size (not really true, mine can do 4k playback, problems really seem to start when kinda going above it as in 2550x3500 etc.), anyway this conversion should only happen when I find something that might make playback problematic for mobile
     # Which is going to boil down to resolution, bitrate (as too large bitrate won't work as wifi streaming) and video encoded in some old/weird encoders that might not work
     global setting_skip_movies
     if setting_skip_movies:
-        return
-    dimensions,duration = get_video_file_info(path)
+        return None
+    dimensions,duration = get_video_dimensions_and_duration(path, file_info)
     if float(duration) < options.min_duration or float(duration) > options.max_duration:
         print(f'Duration of file {hash} outside of options, skipping.')
-        return
-    # This makes sure that aspect ratio is kept
-    resize_settings=f'{options.width}:-1'
-    if dimensions[0] < dimensions[1]:
-        resize_settings=f'-1:{options.height}'
+        return ConversionResult(RESULT_SKIPPED_DURATION, None, options)
 
-    scale = ['','']
-    if options.resize:
-        if options.height < int(dimensions[1]) or options.width < int(dimensions[0]):
-            print(f'Desired resolution lower than original size. Re-encoding.')
-            scale=["-vf",f"scale={resize_settings}"]
-    
-    subprocess.run(['ffmpeg','-i',path,'-c:v',options.codec,'-b:v','0','-crf',str(options.quality),'-row-mt','1',scale[0],scale[1],f'{CONVERSION_OUTPUT_PATH}/{hash}.{options.type}'],capture_output=True,text=True)
+    scale = []
+    scale_filter = get_scale_filter(options, dimensions)
+    if scale_filter:
+        print(f'Desired resolution lower than original size. Re-encoding.')
+        scale=["-vf",scale_filter]
 
-#This checks for existance of transcoded file
-def check_for_existence(hash:str):
-    tag = f"{TRANSCODE_NAMESPACE}:{hash}"
-    files = client.search_files([tag],file_service_name=TRANSCODE_FILE_SERVICE,tag_service_name=TRANSCODE_TAG_SERVICE,return_hashes=True)
-    if len(files) > 1:
-        print(f"Multiple files exist for {hash}:")
-        for file in files:
-            print(f"There exist a transcoded file for {hash} its hash = {file}")
-        return files
-    if len(files) == 1:
-        print(f"There exist a transcoded file for {hash} its hash = {files[0]}")
-        return files
-    if len(files) == 0:
-        print('No transcoded files found')
-        return []
+    encode_options = get_adaptive_settings(options, hash, find_video_quality, path, options, scale_filter, float(duration))
+    output_path = get_temp_output_path(f'{hash}.{options.type}')
+    # Animated webp can't be joined without re-encoding, so only webm goes through chunked encoding
+    if SEGMENT_MIN_DURATION and float(duration) > SEGMENT_MIN_DURATION and options.type == 'webm':
+        conversion = convert_using_ffmpeg_segments(path, encode_options, hash, scale, output_path)
+    else:
+        with time_stage('encode'):
+            return_code = subprocess.run(['ffmpeg','-y','-i',path,'-c:v',options.codec,'-b:v','0','-crf',str(encode_options.quality),'-row-mt','1',*scale,output_path],capture_output=True,text=True)
+        if return_code.returncode != 0:
+            print(f'Conversion error on {path}')
+            conversion = fail_conversion([output_path], encode_options, return_code.stderr)
+        else:
+            conversion = finish_output(path, output_path, encode_options, hash)
+    conversion.options = options
+    return conversion
+
+# Trial encodes a few seconds from the middle of the video, scaled the same way as the full encode
+def find_video_quality(path: str, options: VideoSettings, scale_filter: str, duration: float):
+    sample_duration = min(ADAPTIVE_VIDEO_SAMPLE_DURATION, duration)
+    source = ['-ss',str(max(0, duration / 2 - sample_duration / 2)),'-t',str(sample_duration),'-i',path]
+    scale = ['-vf',scale_filter] if scale_filter else []
+    with tempfile.TemporaryDirectory(prefix='hydrus-transcode-') as temp_folder:
+        def trial(quality: int):
+            trial_path = f'{temp_folder}/trial{quality}.{options.type}'
+            with time_stage('trial'):
+                process = subprocess.run(['ffmpeg','-y',*source,'-an','-c:v',options.codec,'-b:v','0','-crf',str(quality),'-row-mt','1',*scale,trial_path],capture_output=True,text=True)
+                if process.returncode != 0:
+                    raise RuntimeError(f'Trial encode at quality {quality} failed: {process.stderr.strip()[-1000:]}')
+                ssim = measure_ssim(trial_path, source, scale_filter or 'null') if options.target_ssim is not None else None
+            return os.stat(trial_path).st_size * 8 / 1000 / sample_duration, ssim
+        return search_quality(get_quality_candidates(ADAPTIVE_VIDEO_QUALITY_RANGE), trial, options.target_bitrate, options.target_ssim)
+
+# Splits video at keyframes, encodes the pieces in parallel and joins them back together
+def convert_using_ffmpeg_segments(path: str, options: VideoSettings, hash: str, scale: list[str], output_path: str):
+    with tempfile.TemporaryDirectory(prefix='hydrus-transcode-') as temp_folder:
+        # Segment muxer can only cut at keyframes when copying, so pieces are only roughly SEGMENT_LENGTH long
+        with time_stage('split'):
+            return_code = subprocess.run(['ffmpeg','-y','-i',path,'-map','0:v:0','-c','copy','-f','segment','-segment_time',str(SEGMENT_LENGTH),'-reset_timestamps','1',f'{temp_folder}/source%05d.mkv'],capture_output=True,text=True)
+        segments = sorted(name for name in os.listdir(temp_folder) if name.startswith('source'))
+        if return_code.returncode != 0 or not segments:
+            print(f'Splitting error on {path}')
+            return fail_conversion([], options, return_code.stderr)
+        print(f'Encoding {hash} in {len(segments)} segments.')
+
+        def encode_segment(name: str):
+            encoded_path = f"{temp_folder}/encoded{name.removeprefix('source').removesuffix('.mkv')}.webm"
+            return subprocess.run(['ffmpeg','-y','-i',f'{temp_folder}/{name}','-an','-c:v',options.codec,'-b:v','0','-crf',str(options.quality),'-row-mt','1',*scale,encoded_path],capture_output=True,text=True), encoded_path
+        # Wall time of the whole pool, summing time of segments running side by side would make encoder look slower than it is
+        with time_stage('encode'):
+            with ThreadPoolExecutor(max_workers=SEGMENT_JOBS) as segment_pool:
+                encoded = list(segment_pool.map(encode_segment, segments))
+        failed_segments = [process for process, _ in encoded if process.returncode != 0]
+        if failed_segments:
+            print(f'Conversion error on {path}')
+            return fail_conversion([], options, failed_segments[0].stderr)
+
+        with open(f'{temp_folder}/segments.txt', 'w') as segment_list:
+            for _, encoded_path in encoded:
+                segment_list.write(f"file '{encoded_path}'\n")
+        # Video pieces are copied as they are, audio is taken straight from the source in one go so there are no gaps between pieces
+        with time_stage('join'):
+            return_code = subprocess.run(['ffmpeg','-y','-f','concat','-safe','0','-i',f'{temp_folder}/segments.txt','-i',path,'-map','0:v','-map','1:a:0?','-c:v','copy','-c:a','libopus',output_path],capture_output=True,text=True)
+        if return_code.returncode != 0:
+            print(f'Joining error on {path}')
+            return fail_conversion([output_path], options, return_code.stderr)
+
+    return finish_output(path, output_path, options, hash)
+
+# Converts video into every rendition of the ladder with a single ffmpeg run, so the source only gets decoded once
+def convert_using_ffmpeg_ladder(path: str, ladder: list[VideoSettings], hash: str, file_info: FileInfo = None):
+    if setting_skip_movies:
+        return None
+    dimensions,duration = get_video_dimensions_and_duration(path, file_info)
+    if float(duration) < ladder[0].min_duration or float(duration) > ladder[0].max_duration:
+        print(f'Duration of file {hash} outside of options, skipping.')
+        return ConversionResult(RESULT_SKIPPED_DURATION, None, ladder)
+
+    # Renditions that wouldn't shrink the video would all be the same, only first of them is kept
+    renditions = []
+    kept_original_size = False
+    for options in ladder:
+        scale_filter = get_scale_filter(options, dimensions)
+        if scale_filter is None:
+            if kept_original_size:
+                continue
+            kept_original_size = True
+        renditions.append((options, scale_filter))
+
+    # [0:v] gets split into one branch per rendition, each of them scaled on its own
+    filters = [f"[0:v]split={len(renditions)}" + ''.join(f'[v{index}]' for index in range(len(renditions)))]
+    outputs = []
+    output_paths = {}
+    for index, (options, scale_filter) in enumerate(renditions):
+        encode_options = get_adaptive_settings(options, hash, find_video_quality, path, options, scale_filter, float(duration))
+        filters.append(f'[v{index}]{scale_filter or "null"}[out{index}]')
+        label = get_rendition_label(options)
+        output_path = get_temp_output_path(f'{hash}.{label}.{options.type}')
+        output_paths[label] = output_path
+        outputs += ['-map',f'[out{index}]']
+        # Animated webp can't hold audio
+        if options.type != 'webp':
+            outputs += ['-map','0:a?']
+        outputs += ['-c:v',options.codec,'-b:v','0','-crf',str(encode_options.quality),'-row-mt','1',output_path]
+    with time_stage('encode'):
+        return_code = subprocess.run(['ffmpeg','-y','-i',path,'-filter_complex',';'.join(filters),*outputs],capture_output=True,text=True)
+    if return_code.returncode != 0:
+        print(f'Conversion error on {path}')
+        return fail_conversion(list(output_paths.values()), ladder, return_code.stderr)
+
+    # Renditions not worth keeping are dropped one by one, savings are counted once, from the first kept rendition
+    kept_renditions = {}
+    transcode_hashes = []
+    output_sizes = []
+    for label, output_path in output_paths.items():
+        if measure_savings(path, output_path, hash, count_saving=not kept_renditions) == RESULT_LARGER:
+            print(f'Rendition {label} of {hash} is not smaller than original by at least {MIN_OUTPUT_SAVING:.0%}, dropping it.')
+            discard_outputs([output_path])
+            continue
+        transcode_hash, output_size = get_output_hash_and_size(output_path)
+        transcode_hashes.append(transcode_hash)
+        output_sizes.append(output_size)
+        kept_renditions[label] = publish_output(output_path)
+    if not kept_renditions:
+        return ConversionResult(RESULT_LARGER, None, ladder)
+    conversion = ConversionResult(RESULT_CONVERTED, next(iter(kept_renditions.values())), ladder)
+    conversion.renditions = kept_renditions
+    conversion.transcode_hashes = transcode_hashes
+    conversion.transcode_hash = transcode_hashes[0]
+    conversion.output_size = output_sizes[0]
+    return conversion
+
+# Threads sending api requests, kept for the whole run so calls don't pay for starting new ones
+api_pool = None
+api_pool_lock = threading.Lock()
+
+# Keeps enough connections open for all concurrent requests instead of opening a new one for each of them
+def configure_api_connections():
+    global api_pool
+    if isinstance(getattr(client, 'session', None), requests.Session):
+        client.session.mount('http://', requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=API_MAX_IN_FLIGHT))
+        client.session.mount('https://', requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=API_MAX_IN_FLIGHT))
+    with api_pool_lock:
+        if api_pool is not None:
+            api_pool.shutdown()
+        api_pool = ThreadPoolExecutor(max_workers=API_MAX_IN_FLIGHT)
+
+def get_api_pool() -> ThreadPoolExecutor:
+    global api_pool
+    with api_pool_lock:
+        if api_pool is None:
+            api_pool = ThreadPoolExecutor(max_workers=API_MAX_IN_FLIGHT)
+        return api_pool
+
+# Calls client method, retrying with growing delay while hydrus is busy
+def call_api_with_retry(method:str, *args, **kwargs):
+    for attempt in range(API_RETRIES + 1):
+        try:
+            return getattr(client, method)(*args, **kwargs)
+        except RETRYABLE_API_ERRORS as error:
+            if attempt == API_RETRIES:
+                raise
+            delay = API_RETRY_DELAY * 2 ** attempt
+            print(f'Hydrus busy or unreachable ({error}), trying again in {delay}s.')
+            time.sleep(delay)
+
+# Sends all calls at once, at most API_MAX_IN_FLIGHT of them waiting on hydrus at the same time
+# calls is a list of (method name, args, kwargs), results come back in the same order
+def call_api_concurrently(calls:list[tuple[str,list,dict]]) -> list:
+    if len(calls) == 1:
+        method, args, kwargs = calls[0]
+        return [call_api_with_retry(method, *args, **kwargs)]
+    pool = get_api_pool()
+    futures = [pool.submit(call_api_with_retry, method, *args, **kwargs) for method, args, kwargs in calls]
+    return [future.result() for future in futures]
+
+def call_api(method:str, *args, **kwargs):
+    return call_api_concurrently([(method, args, kwargs)])[0]
+
+# Splits list into smaller lists of given size, used to batch api calls
+def split_into_chunks(items:list, size:int):
+    for index in range(0, len(items), size):
+        yield items[index:index + size]
+
+# Fetches metadata in chunks of METADATA_CHUNK_SIZE and yields entries one by one
+# This way neither hydrus nor this script has to hold metadata for whole library at once
+# API_MAX_IN_FLIGHT chunks are requested at the same time, so only that many chunks are in memory
+def iterate_file_metadata(hashes:list[str]):
+    chunks = list(split_into_chunks(hashes, METADATA_CHUNK_SIZE))
+    for window in split_into_chunks(chunks, API_MAX_IN_FLIGHT):
+        with time_stage('metadata'):
+            window_responses = call_api_concurrently([('get_file_metadata', [], {'hashes':chunk}) for chunk in window])
+        for responses in window_responses:
+            for response in responses:
+                yield response
+
+# Hydrus returns metadata entry even for hashes it doesn't know, those just don't have file_id
+def original_exists(response) -> bool:
+    if response.get('file_id') is None:
+        return False
+    if response.get('is_deleted') or response.get('is_trashed'):
+        return False
+    return response.get('is_local', True)
 
 def check_for_original(hashes:list[str]):
-    #Get metadata for given hashes
-    responses = client.get_file_metadata(hashes=hashes)
     files_counter_exist = 0
     files_counter_deleted = 0
     files_counter = 0
-    responses_length = len(responses)
-    for response in responses:
-        #Get tags from the response
-        tags:list[str] = get_tags_from_response(response)
-        #Check if there is a original:<hash> tag in the entries
-        original = ''
-        for tag in tags:
-            if f'{TRANSCODE_NAMESPACE}:' in tag:
-                original = tag.removeprefix(f'{TRANSCODE_NAMESPACE}:')
-                #print(original)
+    responses_length = len(hashes)
+    # original hash => list of transcodes pointing to it
+    transcodes_of_original:dict[str,list[str]] = {}
+    #Get metadata for given hashes
+    for response in iterate_file_metadata(hashes):
         #get hash of the transcoded file
         hash = response.get("hash")
-        print (f"Processing file :{hash}. {files_counter}/{responses_length}.", end="\r")
-
-        #Display whether or not there is a file associated with transcoded one
-        #print(f"{hash} = {original}")
-        #If there is
+        original = get_original_from_response(response)
         if (original != ""):
-            #Search for that file
-            original_file = client.search_files([f"system:hash = {original}"],return_hashes=True)
+            transcodes_of_original.setdefault(original, []).append(hash)
 
-            # The only thing I should ever get back from above search is either a single hash or nothing
-            if len(original_file) == 1:
-                #print(f"Original file for {hash} still exists")
-                files_counter_exist += 1
-            else:
-                files_counter_deleted += 1
-                #print(f"Original file for {hash} is deleted.")
-                #This is where Deletion should happen
-                print(f"Deleting {hash}.")
-                client.delete_files(hashes=[hash],file_service_name=TRANSCODE_FILE_SERVICE,reason="[cleanup] deleted original file")
-        files_counter += 1
-    print (f"Found {len(responses)} files.\n{files_counter_deleted}/{responses_length} deleted.\n{files_counter_exist}/{responses_length} kept.")
+    # Instead of searching for every original one by one, ask for metadata of a whole chunk of them at once
+    originals = list(transcodes_of_original.keys())
+    orphans = []
+    for response in iterate_file_metadata(originals):
+        transcodes = transcodes_of_original.get(response.get('hash'), [])
+        if original_exists(response):
+            files_counter_exist += len(transcodes)
+        else:
+            files_counter_deleted += len(transcodes)
+            orphans.extend(transcodes)
+        files_counter += len(transcodes)
+        print (f"Processing files. {files_counter}/{responses_length}.", end="\r")
+    print()
+
+    #This is where Deletion should happen
+    if orphans:
+        print(f"Deleting {len(orphans)} files.")
+    call_api_concurrently([('delete_files', [], {'hashes':chunk,'file_service_name':TRANSCODE_FILE_SERVICE,'reason':"[cleanup] deleted original file"}) for chunk in split_into_chunks(orphans, DELETE_CHUNK_SIZE)])
+    print (f"Found {responses_length} files.\n{files_counter_deleted}/{responses_length} deleted.\n{files_counter_exist}/{responses_length} kept.")
 
 # This deletes transcoded files for files that don't exist anymore
 def cleanup_procedure():
     #Search for files having transcode original namespace
-    search_response = client.search_files(tags=[f'{TRANSCODE_NAMESPACE}:*'],file_service_name=TRANSCODE_FILE_SERVICE,tag_service_name=TRANSCODE_TAG_SERVICE,return_hashes=True)
+    with time_stage('search'):
+        search_response = call_api('search_files',tags=[f'{TRANSCODE_NAMESPACE}:*'],file_service_name=TRANSCODE_FILE_SERVICE,tag_service_name=TRANSCODE_TAG_SERVICE,return_hashes=True)
     check_for_original(search_response)
 
 def get_tags_from_response(response):
@@ -234,44 +1220,118 @@ def get_tags_from_response(response):
     tags = services.get(TRANSCODE_TAG_SERVICE).get('display_tags').get('0')
     return tags
 
-def convert_file(file_path: str, hash: str):
-    split = os.path.splitext(file_path)
-    fileName = split[0]
-    extension = split[1]
-
-    # Add a check for some minimum settings, so for example 2 hour video doesn't start getting converted as it will take loooong time and probably given how videos like that are, this conversion will look worse and be bigger in size anyway
-    # Proposed criteria
-    # 1. Very large/long video files - maybe I'll find a way to get video length or amount of frames or something
-    # 2. Images and videos (especially videos) that are already small in size/resolution (criteria needed)
-    # 2a. For images probably anything below wanted resolution although reducing a 1080p png still gives huge reduction in file size
-    # Might be interesting to create demo reel/preview kind of thing for long videos, or maybe literally do some sort of youtube like thing where a 360p/480p/720p could be done - as on a phone a lot of times a 480p video (heavily compressed or not) is not that noticably different from a 720p/1080p, unless you really start looking into the details
-    # This obviously require additional support in hydrus-react to have this sort of functionality, and a some edits into philosophy of how I handle recognizing the transcodes
+# Returns hash from <TRANSCODE_NAMESPACE>:<hash> tag of a transcoded file, empty string if there is none
+def get_original_from_response(response) -> str:
+    tags:list[str] = get_tags_from_response(response)
+    original = ''
+    for tag in tags:
+        if tag.startswith(f'{TRANSCODE_NAMESPACE}:'):
+            # Renditions are named <hash>.<WxH>.<type>, so import folder tags them with <hash>.<WxH>, only the hash part counts
+            value = tag.removeprefix(f'{TRANSCODE_NAMESPACE}:').split('.')[0]
+            if re.fullmatch('[0-9a-f]{64}', value):
+                original = value
+    return original
 
+def get_fingerprint_from_response(response) -> str:
+    if not TRANSCODE_SETTINGS_NAMESPACE:
+        return None
+    for tag in get_tags_from_response(response):
+        if tag.startswith(f'{TRANSCODE_SETTINGS_NAMESPACE}:'):
+            return tag.removeprefix(f'{TRANSCODE_SETTINGS_NAMESPACE}:')
+    return None
 
+# Picks settings for a file based on its extension, None if file type doesn't get converted
+def get_conversion_settings(extension: str, size: int):
     if extension in ('.jpg', '.jpeg'):
-        converted_file = convert_using_magick(file_path, IMAGE_SETTINGS_JPG, hash)
+        return IMAGE_SETTINGS_JPG
+    if extension == '.png':
+        return IMAGE_SETTINGS_PNG
+    if extension == '.gif':
+        # Large gifs > 50MB (This limit is arbitrary) should probably be converted using ffmpeg as magick tend to crash with them
+        if size > 50000 * 1024:
+            return VIDEO_SETTINGS_GIF
+        return IMAGE_SETTINGS_GIF
+    if extension in ('.webm', '.mp4', '.avi', '.mkv'):
+        return VIDEO_SETTINGS
+    return None
 
-    if extension in ('.png'):
-        converted_file = convert_using_magick(file_path, IMAGE_SETTINGS_PNG, hash)
+# Settings that really decide how the output looks, for videos with a ladder that's the whole ladder
+def get_effective_settings(options):
+    if options is VIDEO_SETTINGS and VIDEO_LADDER:
+        return VIDEO_LADDER
+    return options
 
-    if extension in ('.gif'):
-        # Large gifs > 50MB (This limit is arbitrary) should probably be converted using ffmpeg as magick tend to crash with them
-        if os.stat(file_path).st_size > 50000 * 1024:
-            print(f"Should be using ffmpeg because file is bigger than 50MB : {os.stat(file_path).st_size / (1024*1024)}MB")
-            converted_file = convert_using_ffmpeg(file_path, VIDEO_SETTINGS_GIF, hash)
-        else:
-            converted_file = convert_using_magick(file_path, IMAGE_SETTINGS_GIF, hash)
-    if extension in ('.webm,.mp4,.avi,.mkv'):
+# Returns 'image' or 'video' depending on which converter is going to handle the file, None if file won't be converted
+def get_conversion_kind(file_path: str):
+    options = get_conversion_settings(os.path.splitext(file_path)[1], os.stat(file_path).st_size)
+    if isinstance(options, ImageSettings):
+        return 'image'
+    if isinstance(options, VideoSettings) and not setting_skip_movies:
+        return 'video'
+    return None
+
+# Uses metadata from hydrus to drop files not worth converting before any process gets started
+# Returns result to save for skipped file, None if file should be converted
+def plan_conversion(hash: str, file_info: FileInfo):
+    skipped = check_skip_conditions(hash, file_info)
+    if skipped is not None:
+        skipped.extension = file_info.extension
+        skipped.original_size = file_info.size
+    return skipped
+
+def check_skip_conditions(hash: str, file_info: FileInfo):
+    options = get_conversion_settings(file_info.extension, file_info.size or 0)
+    if options is None:
+        return ConversionResult(RESULT_SKIPPED_UNSUPPORTED)
+    width, height, size, duration = file_info.width, file_info.height, file_info.size, file_info.duration
+    within_bounds = None not in (width, height) and (not options.resize or (width <= options.width and height <= options.height))
+    if isinstance(options, VideoSettings):
+        if duration is not None and (duration < options.min_duration or duration > options.max_duration):
+            print(f'Duration of file {hash} outside of options, skipping.')
+            return ConversionResult(RESULT_SKIPPED_DURATION, None, options)
+        if within_bounds and size is not None and duration:
+            bitrate = size * 8 / 1000 / duration
+            if bitrate < MIN_VIDEO_BITRATE:
+                print(f'File {hash} is already small ({round(bitrate)}kbit/s), skipping.')
+                return ConversionResult(RESULT_SKIPPED_SMALL, None, options)
+    elif within_bounds and size is not None and size < MIN_IMAGE_SIZE:
+        print(f'File {hash} is already small ({size / 1024}KB), skipping.')
+        return ConversionResult(RESULT_SKIPPED_SMALL, None, options)
+    return None
+
+def convert_file(file_path: str, hash: str, file_info: FileInfo = None):
+    split = os.path.splitext(file_path)
+    fileName = split[0]
+    extension = split[1]
+    conversion = None
+
+    # Might be interesting to create demo reel/preview kind of thing for long videos
+    # 360p/480p/720p variants can be made with VIDEO_LADDER, this obviously require additional support in hydrus-react to have this sort of functionality
+
+    file_size = os.stat(file_path).st_size
+    options = get_conversion_settings(extension, file_size)
+    if isinstance(options, ImageSettings):
+        conversion = convert_image(file_path, options, hash)
+    elif isinstance(options, VideoSettings):
+        if extension == '.gif':
+            print(f"Should be using ffmpeg because file is bigger than 50MB : {file_size / (1024*1024)}MB")
         #print(f'Doing video conversion on {file_path} to {fileName}.webp')
-        converted_file = convert_using_ffmpeg(file_path, VideoSettings(), hash)
-    if converted_file:
-        add_file(converted_file,hash)
-    
-def add_file(path,hash):
+        if options is VIDEO_SETTINGS and VIDEO_LADDER:
+            conversion = convert_using_ffmpeg_ladder(file_path, VIDEO_LADDER, hash, file_info)
+        else:
+            conversion = convert_using_ffmpeg(file_path, options, hash, file_info)
+    if conversion and conversion.renditions:
+        for label, rendition_path in conversion.renditions.items():
+            add_file(rendition_path,hash,[f"{TRANSCODE_RENDITION_NAMESPACE}:{label}"])
+    elif conversion and conversion.output_path:
+        add_file(conversion.output_path,hash)
+    return conversion
+
+def add_file(path,hash,extra_tags:list[str]=[]):
     return
     # Right now it's impossible to add a file to a specific file repo, so this is more of a future thing right now
     #print(f'Adding file :{path}, with hash "{TRANSCODE_NAMESPACE}:{hash}"')
-    #client.add_and_tag_files([path],f"{TRANSCODE_NAMESPACE}:{hash}",service_names=[TRANSCODE_TAG_SERVICE])
+    #client.add_and_tag_files([path],[f"{TRANSCODE_NAMESPACE}:{hash}",*extra_tags],service_names=[TRANSCODE_TAG_SERVICE])
 
 class ServiceInfo:
     def __init__(self,new_name:str,new_key:str):
@@ -336,6 +1396,9 @@ def check_config():
         print(f"Conversion folder doesn't exist trying to make new.")
         os.mkdir(CONVERSION_OUTPUT_PATH)
         conversion_folder_exist=os.path.exists(CONVERSION_OUTPUT_PATH)
+    if not os.path.exists(CONVERSION_TEMP_PATH):
+        os.mkdir(CONVERSION_TEMP_PATH)
+    clean_temp_folder()
     # Check if converter programs are callable, those checks are quite naive but will at least give some form of safety as to whether you can run them through this script
     magick_correct = False
     ffmpeg_correct = False
@@ -344,81 +1407,513 @@ def check_config():
     if (code.returncode == 0):
         magick_correct = True
         #print('Found magick')
+    # Pillow
+    pillow_correct = True
+    if IMAGE_BACKEND == 'pillow':
+        if Image is None:
+            print('Pillow image backend selected, but Pillow is not installed.')
+            pillow_correct = False
+        elif not features.check('webp'):
+            print('Pillow image backend selected, but installed Pillow has no webp support.')
+            pillow_correct = False
     # ffmpeg
     code = subprocess.run('ffmpeg',capture_output=True)
     if (code.returncode == 1):
         ffmpeg_correct = True
         #print('Found ffmpeg')
 
-    return file_service_correct and tag_service_correct and data_folder_correct and magick_correct and ffmpeg_correct
+    return file_service_correct and tag_service_correct and data_folder_correct and magick_correct and ffmpeg_correct and pillow_correct
 
-def get_current_transcodes() -> list[list[str],list[str]]:
+# Builds original hash => hashes of transcodes pointing to it, also fills transcode_fingerprints
+def build_transcode_index(rows:list[tuple[str,str,str]]) -> dict[str,list[str]]:
+    transcode_index:dict[str,list[str]] = {}
+    transcode_fingerprints.clear()
+    for hash, original, fingerprint in rows:
+        if fingerprint:
+            transcode_fingerprints[hash] = fingerprint
+        if original != '':
+            transcode_index.setdefault(original, []).append(hash)
+    # Every rendition of a ladder is a transcode of its own, only more of them than that is suspicious
+    expected_transcodes = max(1, len(VIDEO_LADDER))
+    for original, transcode_hashes in transcode_index.items():
+        if len(transcode_hashes) > expected_transcodes:
+            print(f"Multiple files exist for {original}: {transcode_hashes}")
+    return transcode_index
+
+def get_current_transcodes() -> dict[str,list[str]]:
     #This returns all files in transcode file repo having <transcode_namespace>:<hash> tags
-    transcodes = client.search_files([f'{TRANSCODE_NAMESPACE}:*'],file_service_name=TRANSCODE_FILE_SERVICE,return_hashes=True)
-    #Now for all of them grab all the originals they link to
-    meta_responses = client.get_file_metadata(transcodes)
-    originals = []
-    hashes = []
-    # For each of responses grab their original tag
-    for response in meta_responses:
-        tags:list[str] = get_tags_from_response(response)
-        #Check if there is a original:<hash> tag in the entries
-        hash = response.get('hash')
-        original = ''
-        for tag in tags:
-            if f'{TRANSCODE_NAMESPACE}:' in tag:
-                original = tag.removeprefix(f'{TRANSCODE_NAMESPACE}:')
-                originals.append(original)
-                hashes.append(hash)
-    return originals,hashes
-        
-def start_conversion(hashes:list[str]):
+    with time_stage('search'):
+        transcodes = call_api('search_files',[f'{TRANSCODE_NAMESPACE}:*'],file_service_name=TRANSCODE_FILE_SERVICE,return_hashes=True)
+    if state_database is None:
+        #Now for all of them grab all the originals they link to
+        rows = [(response.get('hash'), get_original_from_response(response), get_fingerprint_from_response(response)) for response in iterate_file_metadata(transcodes)]
+        return build_transcode_index(rows)
+
+    # With local state only transcodes that changed since last run have to be looked at
+    known_transcodes = state_database.get_known_transcodes()
+    current_transcodes = set(transcodes)
+    removed_transcodes = [hash for hash in known_transcodes if hash not in current_transcodes]
+    new_transcodes = [hash for hash in transcodes if hash not in known_transcodes]
+    if removed_transcodes:
+        # Originals which lost their transcode have to be processed again
+        state_database.forget_files(state_database.remove_transcodes(removed_transcodes))
+    rows = [(response.get('hash'), get_original_from_response(response), get_fingerprint_from_response(response)) for response in iterate_file_metadata(new_transcodes)]
+    state_database.add_transcodes(rows)
+    print(f'{len(new_transcodes)} new and {len(removed_transcodes)} removed transcodes since last run.')
+    return build_transcode_index(state_database.get_transcode_rows())
+
+# How many encoders run at the same time for a video, same checks as convert_using_ffmpeg and convert_file
+def get_encoder_count(options:VideoSettings, duration:float) -> int:
+    if options is VIDEO_SETTINGS and VIDEO_LADDER:
+        return len(VIDEO_LADDER)
+    if SEGMENT_MIN_DURATION and duration > SEGMENT_MIN_DURATION and options.type == 'webm':
+        return SEGMENT_JOBS
+    return 1
+
+# Guesses memory, cpu time and savings of a job from what hydrus knows about the file
+# Without metadata (jobs queued before restart) only file size is known, so it falls back to defaults
+def estimate_job_cost(file_info: FileInfo, options, size: int) -> JobCost:
+    width = file_info.width if file_info and file_info.width else 1920
+    height = file_info.height if file_info and file_info.height else 1080
+    frames = file_info.frames if file_info and file_info.frames else 1
+    pixels = width * height
+    slots = 1
+    if isinstance(options, VideoSettings):
+        duration = file_info.duration if file_info and file_info.duration else 30
+        if frames == 1:
+            frames = duration * 30
+        encoders = get_encoder_count(options, duration)
+        # vp9 keeps about 25 frames in flight for lookahead, plus decoder and filter buffers, for each encoder
+        memory = (pixels * 3 // 2 * 40 + 200 * 1024 * 1024) * encoders
+        # Segments split the same work between encoders, ladder encodes the whole video once per rendition
+        cpu_seconds = pixels * frames / VIDEO_PIXELS_PER_SECOND
+        if options is VIDEO_SETTINGS and VIDEO_LADDER:
+            cpu_seconds *= encoders
+        expected_saving = size * (1 - EXPECTED_VIDEO_SIZE_RATIO)
+        slots = min(encoders, MAX_JOBS)
+    else:
+        # magick holds every frame in 16 bit per channel RGBA, that's 8 bytes per pixel
+        memory = pixels * frames * 8 + 50 * 1024 * 1024
+        cpu_seconds = pixels * frames / IMAGE_PIXELS_PER_SECOND
+        expected_saving = size * (1 - EXPECTED_IMAGE_SIZE_RATIO)
+    return JobCost(memory, cpu_seconds, expected_saving, slots)
+
+def new_job_record(hash: str) -> dict:
+    return {'hash': hash, 'stages': {}}
+
+# Held while a job takes its slots of jobs semaphore
+job_slots_lock = threading.Lock()
+
+def run_conversion_job(file_path: str, hash: str, jobs_semaphore: threading.Semaphore, file_info: FileInfo = None, memory_budget: MemoryBudget = None, memory: int = 0, record: dict = None, slots: int = 1):
+    record = record if record is not None else new_job_record(hash)
+    job_metrics.record = record
+    try:
+        # Memory is taken before a job slot, so a job waiting for memory doesn't hold a slot others could use
+        with time_stage('wait'):
+            if memory_budget is not None:
+                memory_budget.acquire(memory)
+            # Jobs taking several slots take them all at once, two of them holding half of the slots each would wait forever
+            with job_slots_lock:
+                for _ in range(slots):
+                    jobs_semaphore.acquire()
+        try:
+            conversion = convert_file(file_path, hash, file_info)
+        finally:
+            # Image and video pools are separate, this semaphore makes sure that together they don't go over MAX_JOBS
+            jobs_semaphore.release(slots)
+            if memory_budget is not None:
+                memory_budget.release(memory)
+        if conversion:
+            conversion.extension = os.path.splitext(file_path)[1]
+            conversion.original_size = os.stat(file_path).st_size
+        options = conversion.options if conversion else None
+        if isinstance(options, list):
+            options = options[0]
+        record['result'] = conversion.result if conversion else None
+        record['format'] = f'{os.path.splitext(file_path)[1]}->{options.type if options else None}'
+        record['input_size'] = os.stat(file_path).st_size
+        record['output_size'] = conversion.output_size if conversion else None
+        record['frames'] = file_info.frames if file_info and file_info.frames and file_info.frames > 1 else None
+        metrics.add_file(record)
+    finally:
+        job_metrics.record = None
+    return hash, conversion
+
+class ConversionWorkers:
+    def __init__(self):
+        # Image and video pools are separate, this semaphore makes sure that together they don't go over MAX_JOBS
+        self.jobs_semaphore = threading.BoundedSemaphore(MAX_JOBS)
+        self.image_pool = ThreadPoolExecutor(max_workers=max(1, min(MAX_IMAGE_JOBS, MAX_JOBS)))
+        self.video_pool = ThreadPoolExecutor(max_workers=max(1, min(MAX_VIDEO_JOBS, MAX_JOBS)))
+        self.memory_budget = MemoryBudget(MEMORY_BUDGET)
+        # Image threads hand the actual encoding to those processes, so it doesn't fight for the GIL
+        global pillow_pool
+        if IMAGE_BACKEND == 'pillow':
+            pillow_pool = ProcessPoolExecutor(max_workers=max(1, min(MAX_IMAGE_JOBS, MAX_JOBS)))
+
+    # Finds the file and hands it to the pool matching its type, returns None if it won't be converted
+    def submit(self,hash:str,file_info:FileInfo=None):
+        record = new_job_record(hash)
+        with time_stage('path', record):
+            path = find_file_in_data(hash, file_info.extension if file_info else None)
+        # print(f"Path resolved to :{path}")
+        if path is None:
+            print(f'Could not find file {hash} in data folder, skipping.')
+            return None
+        kind = get_conversion_kind(path)
+        size = os.stat(path).st_size
+        cost = estimate_job_cost(file_info, get_conversion_settings(os.path.splitext(path)[1], size), size)
+        if kind == 'image':
+            return self.image_pool.submit(run_conversion_job, path, hash, self.jobs_semaphore, file_info, self.memory_budget, cost.memory, record)
+        if kind == 'video':
+            return self.video_pool.submit(run_conversion_job, path, hash, self.jobs_semaphore, file_info, self.memory_budget, cost.memory, record, cost.slots)
+        print(f'File {hash} is not supported for conversion, skipping.')
+        return None
+
+    # cancel_pending drops jobs that haven't started yet, running ones are always waited for
+    def shutdown(self,cancel_pending:bool=False):
+        self.image_pool.shutdown(cancel_futures=cancel_pending)
+        self.video_pool.shutdown(cancel_futures=cancel_pending)
+        global pillow_pool
+        if pillow_pool is not None:
+            pillow_pool.shutdown(cancel_futures=cancel_pending)
+            pillow_pool = None
+
+# Compares fingerprints of existing transcodes with current settings, transcodes without known fingerprint count as stale
+def is_transcode_stale(hash:str, existing_files:list[str], file_info:FileInfo) -> bool:
+    options = get_conversion_settings(file_info.extension, file_info.size or 0)
+    if options is None:
+        return False
+    # Fingerprints made before filter only settings were left out of them still count as current
+    current_fingerprints = {get_settings_fingerprint(get_effective_settings(options)), get_settings_fingerprint(get_effective_settings(options), include_filters=True)}
+    # Transcodes not tagged (yet) fall back to what state database remembers about the original
+    stored_fingerprint = state_database.get_settings_fingerprint(hash) if state_database is not None else None
+    for transcode in existing_files:
+        if transcode_fingerprints.get(transcode, stored_fingerprint) not in current_fingerprints:
+            return True
+    return False
+
+# Tags outputs with <TRANSCODE_NAMESPACE>:<hash> of their original, fingerprint of settings used and renditions with their label
+# Hydrus keeps tags for a hash until the file gets imported, so the link to original doesn't depend on file names import folder sees
+def tag_transcodes(hash:str, conversion:ConversionResult):
+    common_tags = [f'{TRANSCODE_NAMESPACE}:{hash}']
+    if TRANSCODE_SETTINGS_NAMESPACE:
+        common_tags.append(f'{TRANSCODE_SETTINGS_NAMESPACE}:{get_settings_fingerprint(conversion.options)}')
+    # transcode_hashes are in the same order as renditions
+    labels = list(conversion.renditions.keys()) or [None]
+    calls = []
+    for transcode_hash, label in zip(conversion.transcode_hashes, labels):
+        tags = common_tags + ([f'{TRANSCODE_RENDITION_NAMESPACE}:{label}'] if label else [])
+        calls.append(('add_tags', [], {'hashes':[transcode_hash],'service_keys_to_tags':{TRANSCODE_TAG_SERVICE:tags}}))
+    try:
+        call_api_concurrently(calls)
+    except Exception as error:
+        print(f'Could not add tags for transcodes of {hash}: {error}')
+
+# Decides whether file from search should get converted, old transcodes are kept until a replacement is made (see replace_transcodes)
+def check_should_convert(response, transcode_index:dict[str,list[str]]) -> bool:
+    hash = response.get('hash')
+    # Search can return files that are not stored locally anymore, there is nothing to convert for those
+    if not original_exists(response):
+        print(f'File {hash} is not available locally, skipping.')
+        return False
+    # If file has a transcode, check if we are overwriting it, if yes send to transcode, if not set for skipping
+    existing_files = transcode_index.get(hash)
+    if existing_files:
+        #print(f'{hash} already has transcode : {existing_files}')
+        if REENCODE_STALE_FILES and not OVERWRITE_EXISTING_FILES:
+            if not is_transcode_stale(hash, existing_files, FileInfo(response)):
+                print(f'File {hash} has up to date transcoded version, skipping.')
+                return False
+            print(f'Transcode of {hash} was made with different settings, re-encoding.')
+        elif not OVERWRITE_EXISTING_FILES:
+            print(f'File {hash} has transcoded version, skipping.')
+            return False
+    return True
+
+# Deletes transcodes the new conversion replaces, files skipped or dropped after all keep the ones they have
+def replace_transcodes(hash:str, transcode_index:dict[str,list[str]], conversion:ConversionResult):
+    old_transcodes = [transcode for transcode in transcode_index.pop(hash, []) if transcode not in conversion.transcode_hashes]
+    if not old_transcodes:
+        return
+    print(f"Deleting {old_transcodes}")
+    try:
+        call_api('delete_files',hashes=old_transcodes,file_service_name=TRANSCODE_FILE_SERVICE,reason="[transcode] replaced by new transcode")
+    except Exception as error:
+        print(f'Could not delete old transcodes of {hash}: {error}')
+
+# Most saved bytes per second of work go first, so interrupted or time limited runs get the most out of their time
+def order_jobs(jobs:list[tuple[str,FileInfo]]) -> list[tuple[str,FileInfo]]:
+    def get_priority(job):
+        file_info = job[1]
+        size = file_info.size or 0
+        options = get_conversion_settings(file_info.extension, size)
+        return estimate_job_cost(file_info, options, size).priority()
+    return sorted(jobs, key=get_priority, reverse=True)
+
+# Journal has to know about a job before it starts, so it can be picked up again if script dies in the middle
+def submit_job(workers:ConversionWorkers, hash:str, file_info:FileInfo=None):
+    future = workers.submit(hash, file_info)
+    if future is not None and state_database is not None:
+        state_database.start_job(hash)
+    return future
+
+# Saves outcome of a finished job, returns the conversion result
+def finish_conversion(future, hash:str, transcode_index:dict[str,list[str]]=None):
+    try:
+        _, conversion = future.result()
+    except Exception as error:
+        print(f'Conversion of {hash} failed: {error}')
+        conversion = ConversionResult(RESULT_FAILED, error=str(error))
+    # Database is only ever touched from the main thread
+    if state_database is not None:
+        if conversion is not None:
+            state_database.record_result(hash, conversion)
+        if conversion is not None and conversion.result == RESULT_FAILED:
+            state_database.finish_job(hash, JOB_FAILED, conversion.error)
+        else:
+            state_database.finish_job(hash, JOB_DONE)
+    if conversion is not None and conversion.transcode_hashes:
+        tag_transcodes(hash, conversion)
+    if transcode_index is not None and conversion is not None and conversion.result == RESULT_CONVERTED:
+        replace_transcodes(hash, transcode_index, conversion)
+    return conversion
+
+# Originals that already have a transcode would only be skipped after fetching their metadata, so they're dropped before
+# Only when existing transcodes are never replaced, otherwise their metadata is needed to decide that
+def skip_transcoded_hashes(hashes:list[str], transcode_index:dict[str,list[str]]) -> list[str]:
+    if OVERWRITE_EXISTING_FILES or REENCODE_STALE_FILES:
+        return hashes
+    return [hash for hash in hashes if not transcode_index.get(hash)]
+
+def start_conversion(hashes:list[str], skip_done:bool=True):
     # Add a check for existance of transcode for a given a hash and a option whether or not to overwrite it
-    files_that_have_transcodes,transcode_hashes = get_current_transcodes()
-    #return
-    counter = 0
+    transcode_index = get_current_transcodes()
+    remaining_hashes = skip_transcoded_hashes(hashes, transcode_index)
+    if len(remaining_hashes) != len(hashes):
+        print(f'{len(hashes) - len(remaining_hashes)} files already have a transcode, skipping.')
+        hashes = remaining_hashes
+    # Files processed by previous runs are skipped before making any api calls for them
+    # With REENCODE_STALE_FILES already converted files have to be checked again, their settings might have changed
+    if state_database is not None and skip_done and not OVERWRITE_EXISTING_FILES and not REENCODE_STALE_FILES:
+        done_hashes = state_database.get_done_hashes()
+        remaining_hashes = [hash for hash in hashes if hash not in done_hashes]
+        print(f'{len(hashes) - len(remaining_hashes)} files already processed in previous runs, skipping.')
+        hashes = remaining_hashes
+    done_counter = 0
+    submitted_counter = 0
+    workers = ConversionWorkers()
+    # future => hash of file it converts
+    futures = {}
+    jobs = []
+    # Jobs are ordered and submitted a window at a time, so conversions start before whole search is fetched
+    window = max(1, MAX_JOBS * JOB_WINDOW)
+
+    # Handles finished jobs until no more than limit of them are pending
+    def finish_jobs(limit:int):
+        nonlocal done_counter
+        while len(futures) > limit:
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            # Progress is printed in the order files finish, not the order they were found in
+            for future in done:
+                hash = futures.pop(future)
+                done_counter += 1
+                finish_conversion(future, hash, transcode_index)
+                print(f'Done with file {hash} {done_counter}/{submitted_counter}')
+
+    def submit_jobs():
+        nonlocal submitted_counter
+        for hash, file_info in order_jobs(jobs):
+            future = submit_job(workers, hash, file_info)
+            if future is not None:
+                futures[future] = hash
+                submitted_counter += 1
+            elif state_database is not None:
+                state_database.finish_job(hash, JOB_FAILED, 'File not found or not supported')
+        jobs.clear()
+        # Pools only hold about a window of waiting jobs, rest of the search waits for them
+        finish_jobs(window)
+
     # Run for every file found
-    for hash in hashes:
-        should_convert = True
-
-        # TODO This makes sense logically but will require a change to something that is not O(n) in complexity
-        # Probably some sort of hash/map where I will just check for existance of a key, dictionary is a candidate for this
-
-        # If file has a transcode, check if we are overwriting it, if yes send to transcode, if not set for skipping
-        if hash in files_that_have_transcodes:
-            #print(f'{hash} already has transcode : {transcode_hashes[files_that_have_transcodes.index(hash)]}')
-            if OVERWRITE_EXISTING_FILES:
-                should_convert = True
-                # Check whether file exists
-                existing_files = check_for_existence(hash)
-                # for each file associated delete them
-                print(f"Deleting {existing_files}")
-                client.delete_files(hashes=[existing_files],file_service_name=TRANSCODE_FILE_SERVICE,reason="[cleanup] deleted original file")
-            else:
-                should_convert = False
-        if should_convert:
-            path = find_file_in_data(hash)
-            # print(f"Path resolved to :{path}")
-            convert_file(path, hash)
-            print(f'Done with file {counter}/{len(hashes)}')
-        else:
-            print(f'File {hash} has transcoded version, skipping.')
-        counter += 1
+    for response in iterate_file_metadata(hashes):
+        hash = response.get('hash')
+        if check_should_convert(response, transcode_index):
+            file_info = FileInfo(response)
+            skipped = plan_conversion(hash, file_info)
+            if skipped is None:
+                jobs.append((hash, file_info))
+                if len(jobs) >= window:
+                    submit_jobs()
+                continue
+            if state_database is not None:
+                state_database.record_result(hash, skipped)
+        if state_database is not None:
+            # Resumed job that turned out to have nothing left to do
+            state_database.finish_job(hash, JOB_DONE)
+    submit_jobs()
+    finish_jobs(0)
+    workers.shutdown()
 
     print(f"Right now it's impossible(?) to push converted files using api to specified file repository. Manual import required. Recommended using a import folder for now. You can set up all the import options there.")
 
+# Asks hydrus for files matching search and puts the ones never seen before into the queue
+def poll_for_new_files(search:list[str], transcode_index:dict[str,list[str]], seen_hashes:set[str], queued_info:dict[str,FileInfo]):
+    try:
+        with time_stage('search'):
+            results = call_api('search_files', search, return_hashes=True)
+        new_hashes = [hash for hash in results if hash not in seen_hashes]
+        jobs = []
+        for response in iterate_file_metadata(skip_transcoded_hashes(new_hashes, transcode_index)):
+            if check_should_convert(response, transcode_index):
+                hash = response.get('hash')
+                file_info = FileInfo(response)
+                skipped = plan_conversion(hash, file_info)
+                if skipped is not None:
+                    state_database.record_result(hash, skipped)
+                    continue
+                queued_info[hash] = file_info
+                jobs.append((hash, file_info))
+        # Queue keeps insertion order, so ordering the batch here is enough
+        to_convert = [hash for hash, _ in order_jobs(jobs)]
+    except Exception as error:
+        print(f'Polling hydrus failed, will try again next time: {error}')
+        return
+    seen_hashes.update(new_hashes)
+    state_database.enqueue(to_convert)
+    print(f'Found {len(new_hashes)} new files, {len(to_convert)} queued for conversion.')
+
+def run_daemon(search:list[str]):
+    # Queue lives in the state database, without it there is nothing to keep work between restarts
+    if state_database is None:
+        print('Daemon mode requires state database, set --state_db.')
+        return
+    stop_event = threading.Event()
+    def request_stop(signal_number, frame):
+        print('Stopping, waiting for running conversions to finish.')
+        stop_event.set()
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+
+    # Index and list of seen files are kept in memory, so every poll only has to look at new files
+    transcode_index = get_current_transcodes()
+    seen_hashes = state_database.get_done_hashes() if not (OVERWRITE_EXISTING_FILES or REENCODE_STALE_FILES) else set()
+    seen_hashes.update(state_database.get_queued())
+    workers = ConversionWorkers()
+    # future => hash of file it converts
+    pending = {}
+    # Metadata of queued files, files queued before restart don't have it and fall back to ffprobe
+    queued_info:dict[str,FileInfo] = {}
+    next_poll = 0
+    while not stop_event.is_set():
+        if time.monotonic() >= next_poll:
+            data_folder_index.refresh()
+            poll_for_new_files(search, transcode_index, seen_hashes, queued_info)
+            export_metrics()
+            next_poll = time.monotonic() + DAEMON_POLL_INTERVAL
+        for future in [future for future in pending if future.done()]:
+            hash = pending.pop(future)
+            finish_conversion(future, hash, transcode_index)
+            state_database.dequeue(hash)
+            queued_info.pop(hash, None)
+            print(f'Done with file {hash}')
+        # Workers only get a bit more than they can handle at once, rest waits in the database queue
+        if len(pending) < MAX_JOBS * 2:
+            pending_hashes = set(pending.values())
+            for hash in state_database.get_queued(MAX_JOBS * 2 + len(pending)):
+                if hash in pending_hashes:
+                    continue
+                future = submit_job(workers, hash, queued_info.get(hash))
+                if future is None:
+                    state_database.dequeue(hash)
+                    queued_info.pop(hash, None)
+                else:
+                    pending[future] = hash
+        stop_event.wait(1)
+
+    # Jobs that didn't start stay in the queue for next start
+    workers.shutdown(cancel_pending=True)
+    for future, hash in pending.items():
+        if future.cancelled():
+            state_database.cancel_job(hash)
+        else:
+            finish_conversion(future, hash, transcode_index)
+            state_database.dequeue(hash)
+    print('Daemon stopped.')
+
 def resolve_arguments():
     global setting_do_cleanup
     global setting_do_search
     global setting_search_arguments
     global setting_skip_movies
     global OVERWRITE_EXISTING_FILES
+    global REENCODE_STALE_FILES
+    global MAX_JOBS
+    global MAX_IMAGE_JOBS
+    global MAX_VIDEO_JOBS
+    global METADATA_CHUNK_SIZE
+    global STATE_DATABASE_PATH
+    global DAEMON_POLL_INTERVAL
+    global setting_daemon
+    global setting_resume
+    global JOB_MAX_ATTEMPTS
+    global MEMORY_BUDGET
+    global API_MAX_IN_FLIGHT
+    global IMAGE_BACKEND
+    global SEGMENT_MIN_DURATION
+    global SEGMENT_LENGTH
+    global SEGMENT_JOBS
+    global METRICS_JSONL_PATH
+    global METRICS_PROMETHEUS_PATH
+    global setting_profile
+    global MIN_OUTPUT_SAVING
     parser = argparse.ArgumentParser(description="Hydrus-transcode automates transcoding process for hydrus files. This program requires understanding of what you want to achieve. Before usage make sure that configuration (At the top of this file) is correct for your instance, otherwise program might not run (best case scenario) or might delete every file in your hydrus instance (worst case). Thread carefully.")
     parser.add_argument('--skip_movies',action='store_true',help='Skips transcoding of movie files.')
     parser.add_argument('--overwrite',action='store_true',help='Forces overwriting of existing transcode files regardless of settings.')
+    parser.add_argument('--reencode_stale',action='store_true',help='Re-encodes only files whose transcode was made with different settings than current ones.')
     parser.add_argument('--cleanup',action='store_true',help='Runs a cleanup routine, deleting every transcoded file for which th original was deleted. If specified with --search it will run cleanup first, then search.')
     parser.add_argument('--search',nargs='*',default=[],help='Runs a search and convert for given search. Ex. "--search "creator:leonardo da-vinci" "character:mona lisa" " will convert every possible file matching criteria')
+    parser.add_argument('--jobs',type=int,default=MAX_JOBS,help=f'How many files get converted at the same time. Defaults to amount of cores ({MAX_JOBS}).')
+    parser.add_argument('--image_jobs',type=int,default=MAX_IMAGE_JOBS,help='Max amount of image conversions running at the same time.')
+    parser.add_argument('--video_jobs',type=int,default=MAX_VIDEO_JOBS,help='Max amount of video conversions running at the same time.')
+    parser.add_argument('--metadata_chunk_size',type=int,default=METADATA_CHUNK_SIZE,help=f'How many hashes are sent in a single metadata request. Default {METADATA_CHUNK_SIZE}.')
+    parser.add_argument('--state_db',default=STATE_DATABASE_PATH,help=f'Path to local database remembering already processed files. Empty string disables it. Default {STATE_DATABASE_PATH}.')
+    parser.add_argument('--daemon',action='store_true',help='Keeps running and converts new files matching --search as they show up in hydrus. Stops cleanly on SIGTERM.')
+    parser.add_argument('--poll_interval',type=int,default=DAEMON_POLL_INTERVAL,help=f'How often (in seconds) daemon asks hydrus for new files. Default {DAEMON_POLL_INTERVAL}.')
+    parser.add_argument('--image_backend',choices=['magick','pillow'],default=IMAGE_BACKEND,help=f'What encodes images. pillow encodes inside worker processes instead of starting magick for every file. Default {IMAGE_BACKEND}.')
+    parser.add_argument('--segment_min_duration',type=float,default=SEGMENT_MIN_DURATION,help=f'Videos longer than this (in seconds) are encoded in parallel segments. 0 disables it. Default {SEGMENT_MIN_DURATION}.')
+    parser.add_argument('--segment_length',type=float,default=SEGMENT_LENGTH,help=f'Approximate length of a segment in seconds, cuts happen on keyframes. Default {SEGMENT_LENGTH}.')
+    parser.add_argument('--segment_jobs',type=int,default=SEGMENT_JOBS,help=f'How many segments of a single video get encoded at the same time. Default {SEGMENT_JOBS}.')
+    parser.add_argument('--resume',action='store_true',help='Continues jobs that were interrupted or failed in previous runs (requires state database). If specified with --search it will run first.')
+    parser.add_argument('--max_attempts',type=int,default=JOB_MAX_ATTEMPTS,help=f'How many times a failing file is tried before giving up on it. Default {JOB_MAX_ATTEMPTS}.')
+    parser.add_argument('--memory_budget',type=int,default=MEMORY_BUDGET // (1024 * 1024),help=f'How much memory (in MB) conversions running at the same time may use together. Default {MEMORY_BUDGET // (1024 * 1024)}.')
+    parser.add_argument('--api_in_flight',type=int,default=API_MAX_IN_FLIGHT,help=f'How many requests can be sent to hydrus at the same time. Default {API_MAX_IN_FLIGHT}.')
+    parser.add_argument('--min_saving',type=float,default=MIN_OUTPUT_SAVING,help=f'Outputs not smaller than the original by at least this part of its size (0.05 = 5%%) get dropped. Negative value keeps all outputs. Needs --state_db, without it all outputs are kept. Default {MIN_OUTPUT_SAVING if MIN_OUTPUT_SAVING is not None else "keep all outputs"}.')
+    parser.add_argument('--profile',action='store_true',help='Prints how much time every stage of the work took at the end of the run.')
+    parser.add_argument('--metrics_jsonl',default=METRICS_JSONL_PATH,help='Appends timings, sizes and encoder speed of every processed file to this JSON lines file.')
+    parser.add_argument('--metrics_prometheus',default=METRICS_PROMETHEUS_PATH,help='Writes totals to this file in Prometheus text format (for node_exporter textfile collector).')
     arguments = parser.parse_args()
+    MIN_OUTPUT_SAVING = arguments.min_saving if arguments.min_saving is not None and arguments.min_saving >= 0 else None
+    METRICS_JSONL_PATH = arguments.metrics_jsonl
+    METRICS_PROMETHEUS_PATH = arguments.metrics_prometheus
+    if (arguments.profile):
+        setting_profile = True
+    API_MAX_IN_FLIGHT = max(1, arguments.api_in_flight)
+    MEMORY_BUDGET = max(1, arguments.memory_budget) * 1024 * 1024
+    JOB_MAX_ATTEMPTS = max(1, arguments.max_attempts)
+    if (arguments.resume):
+        setting_resume = True
+    SEGMENT_MIN_DURATION = max(0, arguments.segment_min_duration)
+    SEGMENT_LENGTH = max(1, arguments.segment_length)
+    SEGMENT_JOBS = max(1, arguments.segment_jobs)
+    IMAGE_BACKEND = arguments.image_backend
+    DAEMON_POLL_INTERVAL = max(1, arguments.poll_interval)
+    if (arguments.daemon):
+        setting_daemon = True
+    STATE_DATABASE_PATH = arguments.state_db
+    METADATA_CHUNK_SIZE = max(1, arguments.metadata_chunk_size)
+    MAX_JOBS = max(1, arguments.jobs)
+    MAX_IMAGE_JOBS = max(1, arguments.image_jobs)
+    MAX_VIDEO_JOBS = max(1, arguments.video_jobs)
     if (arguments.cleanup == True):
         setting_do_cleanup =True
     if (arguments.skip_movies):
@@ -426,27 +1921,46 @@ def resolve_arguments():
         setting_skip_movies=True
     if (arguments.overwrite):
         OVERWRITE_EXISTING_FILES=True
+    if (arguments.reencode_stale):
+        REENCODE_STALE_FILES=True
     if (arguments.search):
         setting_do_search = True
         split_search = arguments.search
         setting_search_arguments = split_search
-    if not (arguments.search or arguments.cleanup):
+    if not (arguments.search or arguments.cleanup or arguments.resume):
         parser.print_help()
         
      
 services_info = ServicesInfo()
 
 def main():
+    global state_database
     resolve_arguments()
+    configure_api_connections()
     get_services()
     config_correct = check_config()
     if config_correct:
+        if STATE_DATABASE_PATH:
+            state_database = StateDatabase(STATE_DATABASE_PATH)
+        if METRICS_JSONL_PATH:
+            metrics.open_jsonl(METRICS_JSONL_PATH)
         if setting_do_cleanup:
             print('Do a cleanup pass')
             cleanup_procedure()
-        if setting_do_search:
+        if setting_resume:
+            if state_database is None:
+                print('Resuming requires state database, set --state_db.')
+            else:
+                resumable_jobs = state_database.get_resumable_jobs()
+                print(f'Resuming {len(resumable_jobs)} unfinished jobs.')
+                start_conversion(resumable_jobs, skip_done=False)
+        if setting_do_search and setting_daemon:
+            print (f'Running as daemon for {setting_search_arguments}')
+            run_daemon(setting_search_arguments)
+        elif setting_do_search:
             print (f'Do a search and convert for {setting_search_arguments}')
-            results = client.search_files(setting_search_arguments, return_hashes=True)
+            with time_stage('search'):
+                results = call_api('search_files', setting_search_arguments, return_hashes=True)
             print(f"Found {len(results)} files. Starting transcoding process.")
             start_conversion(results)
 
@@ -457,8 +1971,16 @@ def main():
                 print(f"Total size save: {round(total_bytes_saved/(1024*1024),2)}MB")
             else:
                 print(f"Total size save: {round(total_bytes_saved/1024,2)}KB")
+        export_metrics()
+        metrics.close()
+        if setting_profile:
+            metrics.print_summary()
+        if state_database is not None:
+            state_database.close()
     else:
         print('There was an error with parsing config. Aborting...')
 
 
-main()
+# Pillow worker processes might import this file again, this makes sure they don't start another run
+if __name__ == '__main__':
+    main()